@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import mtgsim
+
+
+LARGE_HAND_DECK = """36 Forest
+1 Recycling
+1 Alhammarret's Archive
+1 Font of Mythos
+1 Howling Mine
+1 Temple Bell
+1 Elemental Bond
+1 Rites of Flourishing
+1 Horn of Greed
+1 Diviner's Wand
+1 Mind's Eye
+1 Sol Ring
+1 Mana Crypt
+1 Llanowar Elves
+1 Elvish Mystic
+1 Fyndhorn Elves
+1 Explore
+1 Jade Mage
+1 Ant Queen
+1 Heroes Bane
+1 Abundance
+1 Craterhoof Behemoth
+1 Avenger of Zendikar
+1 Hydra Broodmaster
+1 Primordial Hydra
+"""
+
+LONG_HORIZON_DECK = """52 Forest
+1 Recycling
+1 Genesis Wave
+1 Alhammarret's Archive
+1 Vernal Bloom
+1 Mana Reflection
+1 Zendikar Resurgent
+1 Vorinclex, Voice of Hunger
+1 Exploration
+1 Azusa, Lost but Seeking
+1 Oracle of Mul Daya
+1 Lotus Cobra
+1 Horn of Greed
+1 Nissa, Vital Force
+1 Patron of the Orochi
+1 Birds of Paradise
+1 Joraga Treespeaker
+1 Sol Ring
+1 Mana Crypt
+1 Howling Mine
+1 Temple Bell
+1 Font of Mythos
+1 Explore
+1 Gaea's Touch
+1 Budoka Gardener
+1 Llanowar Druid
+1 Arbor Elf
+1 Concordant Crossroads
+1 Craterhoof Behemoth
+1 Avenger of Zendikar
+1 Hydra Broodmaster
+1 Ant Queen
+1 Heroes Bane
+1 Abundance
+1 Jade Mage
+1 Primordial Hydra
+1 Rampaging Baloths
+1 Kamahl, Fist of Krosa
+1 Undergrowth Champion
+1 Omnath, Locus of Mana
+1 Beacon of Creation
+1 Spidersilk Armor
+1 Retreat to Kazandu
+1 Helix Pinnacle
+1 Prey Upon
+1 Natural Obsolescence
+1 Longtusk Cub
+1 Greenwheel Liberator
+"""
+
+# name: (deck file or inline deck, games, turns)
+# The bundled decks are next to this file, wherever it's run from.
+DECK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WORKLOADS = {
+    'gisela': (os.path.join(DECK_DIR, 'gisela.dck'), 2000, 10),
+    'sealed': (os.path.join(DECK_DIR, 'sealed.dck'), 2000, 10),
+    'testing': (os.path.join(DECK_DIR, 'testing.dck'), 500, 10),
+    'large-hand': (LARGE_HAND_DECK, 300, 15),
+    'long-horizon': (LONG_HORIZON_DECK, 100, 30),
+}
+
+SEED = 20170101
+
+
+def workload_lines(deck):
+    if deck.endswith('.dck'):
+        return mtgsim.read_deck_lines(deck)
+    return tuple(line + '\n' for line in deck.splitlines())
+
+
+def run_workload(deck, games, turns):
+    deck_lines = workload_lines(deck)
+    stages = {}
+    start = time.perf_counter()
+    library, commander = mtgsim.parse_deck(deck_lines)
+    stages['parse'] = time.perf_counter() - start
+    start = time.perf_counter()
+    stats = mtgsim.simulate_range(library, commander, turns, SEED, 0, games)
+    stages['simulate'] = time.perf_counter() - start
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats.report()
+    stages['report'] = time.perf_counter() - start
+    return stats, stages
+
+
+# Seconds spent in each phase of the turn, from a separate pass under the
+# --profile instrumentation so the timed runs aren't slowed down by it.
+def measure_turn_phases(deck, games, turns):
+    profiler = mtgsim.Profiler()
+    profiler.enable()
+    try:
+        run_workload(deck, games, turns)
+    finally:
+        profiler.disable()
+    return {name: profiler.times[name] for name in mtgsim.PROFILED_PHASES if profiler.calls[name] > 0}
+
+
+def measure_memory(deck, games, turns):
+    tracemalloc.start()
+    try:
+        run_workload(deck, games, turns)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summarize_stats(stats):
+    n = stats.num_games
+    return {
+        'mean_mana': [stats.mean(turn) for turn in range(stats.num_turns)],
+        'mean_mana_se': [stats.mean_interval(turn, 1) for turn in range(stats.num_turns)],
+        'median_mana': [stats.median(turn) for turn in range(stats.num_turns)],
+        'spells': [stats.spells_sums[turn] / n for turn in range(stats.num_turns)],
+        'spells_se': [stats.spells_interval(turn, 1) for turn in range(stats.num_turns)],
+        'mulligans': stats.mulligans / n,
+        'mulligans_se': stats.mulligan_interval(1),
+        'cards_drawn': sum(stats.cards_drawn.values()) / n,
+    }
+
+
+def run_benchmarks(names, scale=1.0, repeat=3, memory=True, turn_phases=True):
+    results = {}
+    for name in names:
+        deck, games, turns = WORKLOADS[name]
+        games = max(1, int(games * scale))
+        best = None
+        for i in range(repeat):
+            stats, stages = run_workload(deck, games, turns)
+            if best is None or sum(stages.values()) < sum(best.values()):
+                best = stages
+        result = {
+            'games': games,
+            'turns': turns,
+            'seed': SEED,
+            'games_per_sec': games / best['simulate'],
+            'stages': best,
+            'stats': summarize_stats(stats),
+        }
+        if memory:
+            result['peak_memory_bytes'] = measure_memory(deck, games, turns)
+        if turn_phases:
+            result['turn_phases'] = measure_turn_phases(deck, games, turns)
+        results[name] = result
+        print('{:14} {:9.1f} games/s  parse {:7.4f}s  simulate {:8.3f}s  report {:7.4f}s{}'.format(
+              name, result['games_per_sec'], best['parse'], best['simulate'], best['report'],
+              '  peak {:8.1f} KiB'.format(result['peak_memory_bytes'] / 1024) if memory else ''))
+        if turn_phases:
+            total = sum(result['turn_phases'].values())
+            print('{:14} {}'.format('', '  '.join(
+                  '{} {:.0%}'.format(phase.replace('_phase', ''), seconds / total)
+                  for phase, seconds in result['turn_phases'].items())))
+    return {
+        'version': 1,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'workloads': results,
+    }
+
+
+# Speed is flagged when games/sec drops by more than slowdown, statistics
+# when a mean moves by more than z standard errors. With the same seed and
+# an unchanged engine the statistics come out identical.
+def compare_results(old, new, slowdown=0.1, z=4.0):
+    problems = []
+    for name, current in new['workloads'].items():
+        previous = old['workloads'].get(name)
+        if previous is None:
+            continue
+        if previous['games'] != current['games'] or previous['turns'] != current['turns']:
+            problems.append('{}: workloads differ, not comparable'.format(name))
+            continue
+        ratio = current['games_per_sec'] / previous['games_per_sec']
+        print('{:14} {:9.1f} -> {:9.1f} games/s ({:+.1%})'.format(
+              name, previous['games_per_sec'], current['games_per_sec'], ratio - 1))
+        if ratio < 1 - slowdown:
+            problems.append('{}: {:.1%} slower'.format(name, 1 - ratio))
+        old_stats = previous['stats']
+        new_stats = current['stats']
+        for key, se_key in (('mean_mana', 'mean_mana_se'), ('spells', 'spells_se')):
+            for turn, (a, b) in enumerate(zip(old_stats[key], new_stats[key])):
+                se = (old_stats[se_key][turn] ** 2 + new_stats[se_key][turn] ** 2) ** 0.5
+                if a != b and (se == 0 or abs(a - b) > z * se):
+                    problems.append('{}: {} on turn {} moved from {:.3f} to {:.3f}'.format(
+                                    name, key, turn + 1, a, b))
+        se = (old_stats['mulligans_se'] ** 2 + new_stats['mulligans_se'] ** 2) ** 0.5
+        a, b = old_stats['mulligans'], new_stats['mulligans']
+        if a != b and (se == 0 or abs(a - b) > z * se):
+            problems.append('{}: mulligans moved from {:.3f} to {:.3f}'.format(name, a, b))
+    return problems
+
+
+def main(argv=None):
+    if not argv:
+        argv = sys.argv
+    parser = argparse.ArgumentParser(prog=argv[0],
+                                     description='Fixed-seed benchmarks of the simulator.')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--workloads', nargs='+', choices=sorted(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the number of games')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per workload, the fastest counts')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory pass')
+    parser.add_argument('--no-turn-phases', action='store_true',
+                        help='skip the profiled pass that times each phase of the turn')
+    parser.add_argument('--slowdown', type=float, default=0.1,
+                        help='fraction of games/sec that may be lost before flagging')
+    args = parser.parse_args(argv[1:])
+
+    results = run_benchmarks(args.workloads, args.scale, args.repeat, not args.no_memory,
+                             not args.no_turn_phases)
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as baseline:
+            problems = compare_results(json.load(baseline), results, args.slowdown)
+        for problem in problems:
+            print('REGRESSION', problem)
+        if len(problems) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
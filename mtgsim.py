@@ -1,13 +1,47 @@
 #!/usr/bin/env python3
+import argparse
+import array
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
 import copy
 import functools
+import glob
+import hashlib
+import heapq
+import inspect
+import itertools
+import json
+import math
+import os
 import random
+import socket
 import statistics
+import struct
 import sys
+import threading
+import time
 import traceback
 
 from collections import defaultdict, Counter
 
+# NumPy takes longer to import than the rest of the program, so it's only
+# loaded once something asks for the batch engine.
+np = None
+
+
+def numpy_available():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
+
 
 @functools.lru_cache(maxsize=64)
 def mana_ordering(m):
@@ -18,11 +52,14 @@ def mana_ordering(m):
         return len(m) + 5
 
 
-def order_mana(m):
+def mana_signature(m):
     mana_pool = Counter(m)
+    return tuple(sorted(mana_pool.items(), key=lambda x: (mana_ordering(x[0]), -x[1])))
+
+
+def order_mana(m):
     result = []
-    for key, val in sorted(mana_pool.items(),
-                           key=lambda x: (mana_ordering(x[0]), -x[1])):
+    for key, val in mana_signature(m):
         result += [key] * val
     return result
 
@@ -46,12 +83,296 @@ def can_pay(mana, cost):
     return False
 
 
+# Greedily pays each part of the cost with the first mana in the pool's
+# order that can pay it. Takes and returns pool signatures so the result can
+# be cached, None means the cost can't be paid.
+@functools.lru_cache(maxsize=65536)
+def pay_cost(pool, cost):
+    remaining = [[mana, count] for mana, count in pool]
+    for part in cost:
+        for entry in remaining:
+            if entry[1] > 0 and can_pay(entry[0], part):
+                entry[1] -= 1
+                break
+        else:
+            return None
+    return tuple((mana, count) for mana, count in remaining if count > 0)
+
+
+class ManaPool:
+    def __init__(self):
+        self.counts = {}
+        self.size = 0
+        self._signature = ()
+
+    def add(self, mana):
+        for m in mana:
+            self.counts[m] = self.counts.get(m, 0) + 1
+        self.size += len(mana)
+        self._signature = None
+
+    def signature(self):
+        if self._signature is None:
+            self._signature = mana_signature(self.counts)
+        return self._signature
+
+    def can_pay(self, cost):
+        return pay_cost(self.signature(), cost) is not None
+
+    def pay(self, cost):
+        remaining = pay_cost(self.signature(), cost)
+        if remaining is None:
+            return False
+        self.counts = dict(remaining)
+        self.size -= len(cost)
+        self._signature = None
+        return True
+
+    def spend(self, n):
+        for mana, count in self.signature():
+            if n <= 0:
+                break
+            used = min(n, count)
+            if used == count:
+                del self.counts[mana]
+            else:
+                self.counts[mana] = count - used
+            self.size -= used
+            n -= used
+        self._signature = None
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(order_mana(self.counts))
+
+    def __str__(self):
+        return str(list(self))
+
+
+# The cards in play, in the order they entered. Works like the list it
+# replaces (append, remove, iteration and len), and keeps indexes by name,
+# lands and cards with mana effects so effects don't have to scan every
+# permanent. A card can be in play more than once (search_basic_land puts
+# the land in hand and in play), so each entry gets its own token.
+# Iterating goes over a snapshot, so effects can change the battlefield
+# while it's being walked.
+class Battlefield:
+    def __init__(self):
+        self.entries = {}
+        self.tokens = {}
+        self.by_name = {}
+        self.lands = {}
+        self.nonlands = {}
+        self.mana_sources = {}
+        self.next_token = 0
+        self._mana_effects = ()
+        self.shared = False
+
+    # A copy that shares the indexes with this battlefield until either of
+    # them changes, see fork_game.
+    def fork(self):
+        fork = copy.copy(self)
+        fork.shared = self.shared = True
+        return fork
+
+    def unshare(self):
+        self.entries = dict(self.entries)
+        self.tokens = {card: list(tokens) for card, tokens in self.tokens.items()}
+        self.by_name = {name: dict(named) for name, named in self.by_name.items()}
+        self.lands = dict(self.lands)
+        self.nonlands = dict(self.nonlands)
+        self.mana_sources = dict(self.mana_sources)
+        self.shared = False
+
+    def append(self, card):
+        if self.shared:
+            self.unshare()
+        token = self.next_token
+        self.next_token += 1
+        self.entries[token] = card
+        self.tokens.setdefault(card, []).append(token)
+        self.by_name.setdefault(card.name, {})[token] = card
+        (self.lands if card.is_land else self.nonlands)[token] = card
+        if len(card.mana_effects) > 0:
+            self.mana_sources[token] = card
+            self._mana_effects = None
+
+    # Removes the card's earliest entry, like list.remove.
+    def remove(self, card):
+        tokens = self.tokens.get(card)
+        if not tokens:
+            raise ValueError('{} is not in play'.format(card))
+        if self.shared:
+            self.unshare()
+            tokens = self.tokens[card]
+        token = tokens.pop(0)
+        if len(tokens) == 0:
+            del self.tokens[card]
+        del self.entries[token]
+        named = self.by_name[card.name]
+        del named[token]
+        if len(named) == 0:
+            del self.by_name[card.name]
+        del (self.lands if card.is_land else self.nonlands)[token]
+        if token in self.mana_sources:
+            del self.mana_sources[token]
+            self._mana_effects = None
+
+    def named(self, name):
+        return list(self.by_name.get(name, {}).values())
+
+    def first(self, name):
+        return next(iter(self.by_name.get(name, {}).values()), None)
+
+    def land_cards(self):
+        return list(self.lands.values())
+
+    def nonland_cards(self):
+        return list(self.nonlands.values())
+
+    # Every mana effect in play, in the order Card.generate_mana applies
+    # them. Only rebuilt when a card with mana effects enters or leaves.
+    def mana_effects(self):
+        if self._mana_effects is None:
+            self._mana_effects = tuple(effect for card in self.mana_sources.values()
+                                       for effect in card.mana_effects)
+        return self._mana_effects
+
+    def __contains__(self, card):
+        return card in self.tokens
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries.values()))
+
+
+# The cards left to draw. Shuffling is lazy: shuffle() only forgets the
+# order, and each card is picked at random (one Fisher-Yates step) the first
+# time something looks that deep. A game that sees 20 cards of 99 only pays
+# for 20 picks. The first search indexes the cards by name, after which
+# searches don't scan.
+class Library:
+    def __init__(self, cards, rng):
+        self.cards = list(cards)
+        self.rng = rng
+        self.top = 0
+        # cards[top:top + settled] are in their final order, the rest is
+        # an unordered pile.
+        self.settled = len(self.cards)
+        self.positions = None
+        self.by_name = None
+        self.name_positions = None
+
+    def build_index(self):
+        self.positions = {}
+        self.by_name = {}
+        self.name_positions = {}
+        for i in range(self.top, len(self.cards)):
+            self.index(self.cards[i], i)
+
+    def index(self, card, position):
+        self.positions[card] = position
+        named = self.by_name.setdefault(card.name, [])
+        self.name_positions[card] = len(named)
+        named.append(card)
+
+    def unindex(self, card):
+        del self.positions[card]
+        named = self.by_name[card.name]
+        i = self.name_positions.pop(card)
+        last = named.pop()
+        if last is not card:
+            named[i] = last
+            self.name_positions[last] = i
+
+    def settle(self, n):
+        cards = self.cards
+        end = len(cards)
+        random = self.rng.random
+        positions = self.positions
+        for i in range(self.top + self.settled, self.top + n):
+            j = i + int(random() * (end - i))
+            cards[i], cards[j] = cards[j], cards[i]
+            if positions is not None:
+                positions[cards[i]] = i
+                positions[cards[j]] = j
+        self.settled = max(self.settled, n)
+
+    def shuffle(self):
+        self.settled = 0
+
+    def shuffle_in(self, cards):
+        for card in cards:
+            if self.positions is not None:
+                self.index(card, len(self.cards))
+            self.cards.append(card)
+        self.shuffle()
+
+    def draw(self, n):
+        n = min(n, len(self.cards) - self.top)
+        if self.settled < n:
+            self.settle(n)
+        drawn = self.cards[self.top:self.top + n]
+        if self.positions is not None:
+            for card in drawn:
+                self.unindex(card)
+        self.top += n
+        self.settled -= n
+        return drawn
+
+    # Takes a random card with one of the names and shuffles the library,
+    # which in a shuffled library is the same as taking the first one.
+    def search(self, names):
+        if self.positions is None:
+            self.build_index()
+        candidates = [self.by_name.get(name, ()) for name in names]
+        total = sum(len(named) for named in candidates)
+        if total == 0:
+            return None
+        pick = self.rng.randrange(total)
+        for named in candidates:
+            if pick < len(named):
+                card = named[pick]
+                break
+            pick -= len(named)
+        top_card = self.cards[self.top]
+        position = self.positions[card]
+        self.cards[position] = top_card
+        self.positions[top_card] = position
+        self.unindex(card)
+        self.top += 1
+        self.shuffle()
+        return card
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if self.settled <= i:
+            self.settle(i + 1)
+        return self.cards[self.top + i]
+
+    def __len__(self):
+        return len(self.cards) - self.top
+
+    # Only the settled cards come in order, iterate when order doesn't
+    # matter.
+    def __iter__(self):
+        return iter(self.cards[self.top:])
+
+
 class Card:
+    __slots__ = ('name', 'cost', 'managen', 'delay', 'mana_effects', 'turn_effects', 'play_effects',
+                 'is_land', 'survival_chance', 'is_commander', 'priority_keys')
+
     def __init__(self, name="Blank Name", cost=[], managen=(), delay=0,
                  mana_effects=[], is_land=False, survival_chance=1.0,
                  turn_effects=[], play_effects=[]):
         self.name = name
-        self.cost = cost[::-1]
+        self.cost = tuple(cost[::-1])
         self.managen = managen
         self.delay = delay
         self.mana_effects = mana_effects
@@ -60,70 +381,77 @@ class Card:
         self.is_land = is_land
         self.survival_chance = survival_chance
         self.is_commander = False
+        # Compiled PriorityTable keys, shared by the copies of the card.
+        self.priority_keys = {}
+
+    # Cards are shared between games, so anything that changes during a game
+    # is kept in the env and looked up through these.
+    def current_cost(self, env):
+        if self.is_commander:
+            return self.cost + (1, 1) * env['commander_tax']
+        return self.cost
+
+    def current_delay(self, env):
+        return env['delays'].get(self, self.delay)
+
+    def current_play_effects(self, env):
+        return self.play_effects + env['extra_play_effects'].get(self, [])
 
     def can_play(self, env):
         if self.is_land:
             return env['land_plays'] > 0
         else:
-            remaining_mana = order_mana(env['mana_pool'])
-            payable = True
-            for cost in self.cost:
-                for mana in remaining_mana:
-                    if can_pay(mana, cost):
-                        to_remove = mana
-                        break
-                else:
-                    payable = False
-                    break
-                remaining_mana.remove(to_remove)
-            return payable
+            return env['mana_pool'].can_pay(self.current_cost(env))
 
     def play(self, env, free=False):
         if not free:
             if self.is_land:
                 env['land_plays'] -= 1
+                env['turn_land_plays'][env['turn'] - 1] += 1
             else:
-                env['mana_pool'].sort(key=mana_ordering)
-                payed = 0
-                for cost in self.cost:
-                    for mana in env['mana_pool']:
-                        if can_pay(mana, cost):
-                            env['mana_pool'].remove(mana)
-                            payed += 1
-                            break
-                    else:
-                        if payed < len(self.cost):
-                            print("Failed to pay {}, with {}".format(self.cost, env['mana_pool']))
-                            raise ValueError("Couldn't play the card")
+                cost = self.current_cost(env)
+                if not env['mana_pool'].pay(cost):
+                    print("Failed to pay {}, with {}".format(list(cost), env['mana_pool']))
+                    raise ValueError("Couldn't play the card")
         if env['example']:
             print("Playing {}".format(self.name))
+        if env['trace'] is not None:
+            env['trace'].add(TRACE_PLAY, self.name)
         for effect in self.play_effects:
             effect(env)
+        # Effects added while this card resolves (e.g. by a Genesis Wave reveal)
+        # still trigger, so iterate the live list.
+        for effect in env['extra_play_effects'].get(self, []):
+            effect(env)
         env['cards_played'].append((self.name, env['turn']))
 
     def generate_mana(self, env):
-        if self.delay > 0:
-            self.delay -= 1
+        delay = self.current_delay(env)
+        if delay > 0:
+            env['delays'][self] = delay - 1
             if env['use_delay']:
                 return ()
         mana_generated = copy.copy(self.managen)
-        for card in env['played_cards']:
-            for effect in card.mana_effects:
-                mana_generated = effect(self, mana_generated)
+        for effect in env['played_cards'].mana_effects():
+            mana_generated = effect(env, self, mana_generated)
         # print('{} generated {}'.format(self.name, mana_generated))
-        env['mana_pool'] += mana_generated
+        env['mana_pool'].add(mana_generated)
         env['mana_generated'] += len(mana_generated)
+        if env['trace'] is not None and len(mana_generated) > 0:
+            env['trace'].add(TRACE_MANA, self.name, len(mana_generated))
         return mana_generated
 
     def survives_turn(self, env):
         return self.survival_chance != 0
-        return random.random() < self.survival_chance
+        return env['rng'].random() < self.survival_chance
 
     def __str__(self):
         return self.name
 
 
 class FillerCard(Card):
+    __slots__ = ()
+
     def can_play(self, env):
         return False
 
@@ -134,7 +462,7 @@ def increase_land_plays(n):
     return fun
 
 
-def increase_from_forests(card, mana):
+def increase_from_forests(env, card, mana):
     if card.name == 'Forest':
         mana += ('G',)
     return mana
@@ -146,26 +474,25 @@ def draw_land_if_top(env):
 
 
 def draw_cards(env, n):
-    to_draw = env['library'][:n]
+    to_draw = env['library'].draw(n)
     env['hand'] += to_draw
-    env['library'] = env['library'][n:]
+    if env['trace'] is not None:
+        for card in to_draw:
+            env['trace'].add(TRACE_DRAW, card.name)
     env['cards_drawn'] += [(card.name, env['turn']) for card in to_draw]
     if env['example']:
         print('Drawing', ', '.join(['{}'] * len(to_draw)).format(*to_draw))
 
 
-draw_multiplier = 1
-
-
 def draw_cards_effect(n):
     def fun(env):
-        draw_cards(env, n * draw_multiplier)
+        draw_cards(env, n * env['draw_multiplier'])
     return fun
 
 
-def double_land(card, mana):
+def double_land(env, card, mana):
     if card.is_land and len(card.managen) > 0:
-        mana += (random.choice(mana),)
+        mana += (env['rng'].choice(mana),)
     return mana
 
 
@@ -175,31 +502,43 @@ def add_effect_spell(cost, effect, name=None, repeatable=False):
     if isinstance(cost, int):
         cost = [1] * cost
 
+    priority_keys = {}
+
     def fun(env):
-        effect_spell = Card(name=name, cost=cost, survival_chance=0,
-                            play_effects=[effect])
-        if repeatable:
-            effect_spell.play_effects.append(fun)
-        env['hand'].append(effect_spell)
+        env['hand'].append(new_effect_spell(name, cost, [effect, fun] if repeatable else [effect],
+                                            priority_keys))
     return fun
 
 
-def double_gen(card, mana):
+# The spells of add_effect_spell, made as games run. A module function so
+# --profile can time their effects.
+def new_effect_spell(name, cost, play_effects, priority_keys):
+    effect_spell = Card(name=name, cost=cost, survival_chance=0, play_effects=play_effects)
+    effect_spell.priority_keys = priority_keys
+    return effect_spell
+
+
+def double_gen(env, card, mana):
     mana += mana
     return mana
 
 
+def add_extra_play_effect(env, card, effect):
+    env['extra_play_effects'].setdefault(card, []).append(effect)
+    env['effects_version'] += 1
+
+
 def recycle_effect(env):
     for card in env['hand']:
         if card.name != "Recycling":
-            card.play_effects.append(draw_cards_effect(1))
+            add_extra_play_effect(env, card, draw_cards_effect(1))
     for card in env['library']:
-        card.play_effects.append(draw_cards_effect(1))
+        add_extra_play_effect(env, card, draw_cards_effect(1))
 
 
 def add_mana(mana):
     def fun(env):
-        env['mana_pool'].append(mana)
+        env['mana_pool'].add((mana,))
         env['mana_generated'] += len(mana)
     return fun
 
@@ -208,24 +547,22 @@ def add_play_effect(filter_func, effect):
     def fun(env):
         for card in env['hand']:
             if filter_func(card):
-                card.play_effects.append(effect)
+                add_extra_play_effect(env, card, effect)
         for card in env['library']:
             if filter_func(card):
-                card.play_effects.append(effect)
+                add_extra_play_effect(env, card, effect)
     return fun
 
 
 def untap_forest(env):
-    for card in env['played_cards']:
-        if card.name == 'Forest':
-            card.generate_mana(env)
-            break
+    forest = env['played_cards'].first('Forest')
+    if forest is not None:
+        forest.generate_mana(env)
 
 
 def untap_all_forests(env):
-    for card in env['played_cards']:
-        if card.name == 'Forest':
-            card.generate_mana(env)
+    for card in env['played_cards'].named('Forest'):
+        card.generate_mana(env)
 
 
 def bounce_forest(env):
@@ -234,64 +571,57 @@ def bounce_forest(env):
         if card.is_land:
             lands += 1
     if lands < 3:
-        for card in env['played_cards']:
-            if card.name == 'Forest':
-                env['played_cards'].remove(card)
-                env['hand'].append(card)
-                break
+        forest = env['played_cards'].first('Forest')
+        if forest is not None:
+            env['played_cards'].remove(forest)
+            env['hand'].append(forest)
 
 
 def kill_card(name):
     def fun(env):
-        for card in env['played_cards']:
-            if card.name == name:
-                env['played_cards'].remove(card)
-                break
+        card = env['played_cards'].first(name)
+        if card is not None:
+            env['played_cards'].remove(card)
     return fun
 
 
 def alhammarret_effect(env):
-    global draw_multiplier
-    draw_multiplier = 2
+    env['draw_multiplier'] = 2
 
 
 def genesis_wave_effect(env):
     quantity = min(8 + len(env['mana_pool']), len(env['library']))
-    env['mana_pool'] = env['mana_pool'][quantity - 8:]
+    if quantity >= 8:
+        env['mana_pool'].spend(quantity - 8)
+    else:
+        env['mana_pool'].spend(len(env['mana_pool']) - (8 - quantity))
     if env['example']:
         print("Genesis Wave for {} out of {}".format(quantity, len(env['library'])))
     for i in range(quantity):
-        card = None
-        try:
-            card = env['library'].pop(0)
-        except IndexError:
+        revealed = env['library'].draw(1)
+        if len(revealed) == 0:
             break
+        card = revealed[0]
         card.play(env, free=True)
         env['played_cards'].append(card)
         card.generate_mana(env)
 
 
+BASIC_LANDS = ["Plains", "Island", "Swamp", "Mountain", "Forest", "Wastes"]
+# BASIC_LANDS = ["Plains"]
+
+
 def search_basic_land(env):
-    basic_lands = ["Plains", "Island", "Swamp", "Mountain", "Forest", "Wastes"]
-    # basic_lands = ["Plains"]
-    for card in env['library']:
-        if card.name in basic_lands:
-            env['hand'].append(card)
-            env['library'].remove(card)
-            random.shuffle(env['library'])
-            env['played_cards'].append(card)
-            break
+    card = env['library'].search(BASIC_LANDS)
+    if card is not None:
+        env['hand'].append(card)
+        env['played_cards'].append(card)
 
 
 def basic_land_to_battlefield(env):
-    basic_lands = ["Plains", "Island", "Swamp", "Mountain", "Forest", "Wastes"]
-    # basic_lands = ["Plains"]
-    for card in env['library']:
-        if card.name in basic_lands:
-            card.play(env, free=True)
-            env['library'].remove(card)
-            random.shuffle(env['library'])
-            break
+    card = env['library'].search(BASIC_LANDS)
+    if card is not None:
+        card.play(env, free=True)
 
 
 def remove_delay(env):
@@ -543,7 +873,233 @@ def create_cards():
             }
 
 
-cards = create_cards()
+# The registry is built by create_cards() the first time a card is looked
+# up, not on import.
+class CardRegistry(collections.abc.Mapping):
+    def __init__(self, factory):
+        self.factory = factory
+        self.built = None
+        self.lock = threading.Lock()
+
+    def definitions(self):
+        if self.built is None:
+            with self.lock:
+                if self.built is None:
+                    self.built = self.factory()
+        return self.built
+
+    def get(self, name, default=None):
+        return self.definitions().get(name, default)
+
+    def __getitem__(self, name):
+        return self.definitions()[name]
+
+    def __iter__(self):
+        return iter(self.definitions())
+
+    def __len__(self):
+        return len(self.definitions())
+
+
+cards = CardRegistry(create_cards)
+
+
+# Numbers for each distinct set of rules, by the parts of the rules compiled
+# keys depend on. Cards cache their keys under these, so tables with the same
+# rules share them and cached keys don't keep tables alive.
+RULE_SIGNATURES = {}
+RULE_SIGNATURES_LOCK = threading.Lock()
+
+
+def rules_signature(rules):
+    signature = tuple(tuple((field, tuple(rule[field]) if field in ('names', 'except') else rule[field])
+                            for field in ('names', 'except', 'land', 'has', 'key') if field in rule)
+                      for rule in rules)
+    with RULE_SIGNATURES_LOCK:
+        return RULE_SIGNATURES.setdefault(signature, len(RULE_SIGNATURES))
+
+
+# A strategy's priority rules (see PLAY_PRIORITIES) with the keys worked out
+# per card. Matching and keys only depend on the card, and on how many play
+# effects and what delay it has this game, so they're compiled once per card
+# definition and reused by every copy in every game.
+class PriorityTable:
+    def __init__(self, rules):
+        self.rules = rules
+        self.signature = rules_signature(rules)
+        self.random = [rule.get('key') == 'random' for rule in rules]
+        self.whens = [rule.get('when') for rule in rules]
+        self.tests = [rule.get('test') for rule in rules]
+
+    def card_keys(self, card, env):
+        extra = env['extra_play_effects'].get(card)
+        delay = env['delays'].get(card)
+        key = self.signature if extra is None and delay is None else (self.signature, len(extra or ()), delay)
+        compiled = card.priority_keys.get(key)
+        if compiled is None or compiled[0] != card.name:
+            compiled = card.priority_keys[key] = (card.name, self.compile(card, env))
+        return compiled[1]
+
+    # (rule index, key) for each rule the card matches, in order.
+    def compile(self, card, env):
+        keys = []
+        for index, rule in enumerate(self.rules):
+            if 'names' in rule and card.name not in rule['names']:
+                continue
+            if card.name in rule.get('except', ()):
+                continue
+            if 'land' in rule and card.is_land != rule['land']:
+                continue
+            if 'has' in rule and len(card_property(card, rule['has'], env)) == 0:
+                continue
+            keys.append((index, self.key(rule, card, env)))
+        return tuple(keys)
+
+    def key(self, rule, card, env):
+        spec = rule.get('key')
+        if spec is None or spec == 'random':
+            return 0
+        if spec == 'listed':
+            return rule['names'].index(card.name)
+        sign = 1
+        if spec.startswith('-'):
+            sign = -1
+            spec = spec[1:]
+        total = 0
+        for name in spec.split('+'):
+            value = card_property(card, name, env)
+            total += value if isinstance(value, int) else len(value)
+        return sign * total
+
+    # Cards in the order the table ranks them: by the first rule they match
+    # and its key, then by their order in cards. Cards no rule matches come
+    # last.
+    def order(self, cards, env):
+        ranks = {}
+        for card in cards:
+            keys = self.card_keys(card, env)
+            if len(keys) == 0:
+                ranks[card] = (len(self.rules), 0)
+            elif self.random[keys[0][0]]:
+                ranks[card] = (keys[0][0], env['rng'].random())
+            else:
+                ranks[card] = keys[0]
+        return sorted(cards, key=ranks.__getitem__)
+
+
+# Properties priority rules can use. Play effects and delays include the ones
+# the card picked up this game.
+def card_property(card, name, env):
+    if name == 'play_effects':
+        return card.current_play_effects(env)
+    if name == 'delay':
+        return card.current_delay(env)
+    return getattr(card, name)
+
+
+# Keeps the candidates for each priority rule up to date as the hand changes,
+# instead of re-filtering and sorting the whole hand on every pick. Picks are
+# the same as sorting each rule's playable choices.
+class PlayTracker:
+    def __init__(self, env, table):
+        self.env = env
+        self.table = table
+        self.state = None
+        self.playable = {}
+        self.reset()
+
+    def reset(self):
+        self.positions = {}
+        self.next_position = 0
+        self.candidates = [{} if random else [] for random in self.table.random]
+        self.effects_version = self.env['effects_version']
+        self.known = 0
+        self.add_cards(self.env['hand'])
+
+    def add_cards(self, new_cards):
+        for card in new_cards:
+            position = self.next_position
+            self.next_position += 1
+            self.positions[card] = position
+            for index, key in self.table.card_keys(card, self.env):
+                if self.table.random[index]:
+                    self.candidates[index][card] = position
+                else:
+                    heapq.heappush(self.candidates[index], (key, position, card))
+        self.known = len(self.env['hand'])
+
+    # Cards only leave the hand when the last pick gets played, anything else
+    # gets appended, so only the tail of the hand needs to be looked at.
+    def update(self, last_pick):
+        hand = self.env['hand']
+        if self.env['effects_version'] != self.effects_version:
+            self.reset()
+            return
+        start = self.known
+        if last_pick is not None and last_pick not in hand:
+            del self.positions[last_pick]
+            for candidates in self.candidates:
+                if isinstance(candidates, dict):
+                    candidates.pop(last_pick, None)
+            start -= 1
+        if len(hand) < start:
+            self.reset()
+            return
+        self.add_cards(hand[start:])
+
+    def refresh_state(self):
+        env = self.env
+        state = (env['mana_pool'].signature(), env['land_plays'] > 0, env['commander_tax'])
+        if state != self.state:
+            self.state = state
+            self.playable = {}
+
+    def is_playable(self, card):
+        playable = self.playable.get(card)
+        if playable is None:
+            playable = self.playable[card] = card.can_play(self.env)
+        return playable
+
+    def playable_cards(self):
+        self.refresh_state()
+        return [card for card in self.env['hand'] if self.is_playable(card)]
+
+    def best_playable(self, heap, test):
+        skipped = []
+        best = None
+        while heap:
+            key, position, card = heap[0]
+            if self.positions.get(card) != position:
+                heapq.heappop(heap)
+            elif self.is_playable(card) and (test is None or test(card, self.env)):
+                best = card
+                break
+            else:
+                skipped.append(heapq.heappop(heap))
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return best
+
+    def pick(self):
+        self.refresh_state()
+        rng = self.env['rng']
+        table = self.table
+        for random, when, test, candidates in zip(table.random, table.whens, table.tests, self.candidates):
+            if when is not None and not when(self.env):
+                continue
+            if random:
+                choices = [card for card in candidates
+                           if self.is_playable(card) and (test is None or test(card, self.env))]
+                if len(choices) > 0:
+                    return min(choices, key=lambda c: rng.random())
+            else:
+                card = self.best_playable(candidates, test)
+                if card is not None:
+                    return card
+        playable = self.playable_cards()
+        if len(playable) > 0:
+            return rng.choice(playable)
+        return None
 
 
 # Lands based
@@ -562,6 +1118,13 @@ def should_mulligan(hand):
     # return lands < lands_needed[len(hand)] or lands >= overloaded_lands[len(hand)]
 
 
+# Cards should_mulligan can't tell apart, used to compute mulligans exactly.
+# Keep it in step with should_mulligan: every card it looks at differently
+# needs its own class.
+def mulligan_class(card):
+    return card.name == "Recycling", len(card.managen) > 0
+
+
 # def should_mulligan(hand):
 #     mana = 0
 #     lands = 0
@@ -592,7 +1155,7 @@ def should_mulligan(hand):
 #                 ),
 #                 (
 #                     lambda c: len(c.cost) == len(env['mana_pool']),
-#                     lambda c: random.random()
+#                     lambda c: env['rng'].random()
 #                 ),
 #               ] # noqa
 #     while True:
@@ -612,258 +1175,2892 @@ def should_mulligan(hand):
 #         else:
 #             # if env['example']:
 #             #     print("Couldn't find anything good to play so random")
-#             yield random.choice(playable)
+#             yield env['rng'].choice(playable)
+
+
+# should_play's priorities. Rules are tried in order and the first one with
+# a playable card plays its card with the lowest key, earliest in hand on
+# ties. If no rule has one, a random playable card is played. A rule can
+# match on
+#   'names': only these cards, 'except': never these cards,
+#   'land': True or False,
+#   'has': a property that must not be empty (managen, mana_effects,
+#          play_effects or turn_effects),
+# and 'key' orders its cards by
+#   'listed': their position in 'names',
+#   'random': a fresh random number on every pick,
+#   properties joined by '+', where lists count their length, e.g.
+#   'delay' or '-managen+mana_effects' (with a '-' the largest goes first).
+# These only look at the card, so they're worked out once per card. Tests
+# that depend on the state of the game are checked on every pick:
+#   'when': a function of env, the rule is skipped unless it's true,
+#   'test': a function of (card, env) a card must pass to be picked,
+# e.g. {'test': lambda c, env: len(c.cost) == len(env['mana_pool'])}.
+PLAY_PRIORITIES = [
+    {'has': 'mana_effects', 'key': '-mana_effects'},
+    {'names': ["Genesis Wave", "Recycling", "Alhammarret's Archive", "Gisela, Blade of Goldnight",
+               "Azusa, Lost but Seeking", "Patron of the Orochi", "Exploration"], 'key': 'listed'},
+    {'has': 'play_effects', 'except': ["Draw Spell"], 'key': 'random'},
+    {'has': 'managen', 'key': 'delay'},
+    {'has': 'turn_effects', 'key': 'random'},
+    {'names': ["Draw Spell"]},
+]
+
+# should_discard's priorities, the first cards in this order are discarded.
+DISCARD_PRIORITIES = [
+    {'key': 'managen+turn_effects+play_effects+mana_effects'},
+]
+
+play_table = PriorityTable(PLAY_PRIORITIES)
+discard_table = PriorityTable(DISCARD_PRIORITIES)
 
 
 def should_play(env):
-    important_cards = ["Genesis Wave", "Recycling", "Alhammarret's Archive", "Gisela, Blade of Goldnight",
-                       "Azusa, Lost but Seeking", "Patron of the Orochi", "Exploration"]
-    filters = [
-                    ( # noqa
-                        lambda c: len(c.mana_effects) > 0,
-                        lambda c: -len(c.mana_effects)
-                    ),
-                    (
-                        lambda c: c.name in important_cards,
-                        lambda c: important_cards.index(c.name)
-                    ),
-                    (
-                        lambda c: len(c.play_effects) > 0 and c.name != "Draw Spell",
-                        lambda c: random.random()
-                    ),
-                    (
-                        lambda c: len(c.managen) > 0,
-                        lambda c: c.delay
-                    ),
-                    (
-                        lambda c: len(c.turn_effects) > 0,
-                        lambda c: random.random()
-                    ),
-                    (
-                        lambda c: c.name == "Draw Spell",
-                        lambda c: 1
-                    )
-                   ] # noqa
+    yield from play_by_priorities(env, play_table)
+
+
+def should_discard(env, num):
+    return discard_table.order(env['hand'], env)[:num]
+
+
+def play_by_priorities(env, table):
+    tracker = PlayTracker(env, table)
+    card = None
     while True:
-        playable = [card for card in env['hand'] if card.can_play(env)]
-        if len(playable) == 0:
-            break
+        tracker.update(card)
         if env['example']:
-            print('Playable: ', ', '.join(['{}'] * len(playable)).format(*sorted(playable,
-                                                                                 key=lambda x: x.name)))
-        for func, key in filters:
-            choices = [card for card in playable if func(card)]
-            if len(choices) > 0:
-                # if env['example']:
-                #     print("Using a choice function")
-                yield sorted(choices, key=key)[0]
-                break
-        else:
-            # if env['example']:
-            #     print("Couldn't find anything good to play so random")
-            yield random.choice(playable)
+            playable = tracker.playable_cards()
+            if len(playable) > 0:
+                print('Playable: ', ', '.join(['{}'] * len(playable)).format(*sorted(playable,
+                                                                                     key=lambda x: x.name)))
+        card = tracker.pick()
+        if card is None:
+            break
+        yield card
 
 
-def should_discard(env, num):
-    cards = sorted(env['hand'], key=lambda x: len(x.managen) +
-                                              len(x.turn_effects + x.play_effects + # noqa
-                                                  x.mana_effects))
-    return cards[:num]
+# The decisions made during a game, kept in env['strategy']. The default
+# plays by should_mulligan, should_play and should_discard (as they are at
+# the time, so edits and --profile still apply). Subclass it, or give it
+# other priority tables, to play games differently without changing the
+# module, e.g. Strategy(play_priorities=[...]).
+class Strategy:
+    def __init__(self, play_priorities=None, discard_priorities=None):
+        self.play_table = None if play_priorities is None else PriorityTable(play_priorities)
+        self.discard_table = None if discard_priorities is None else PriorityTable(discard_priorities)
 
+    def should_mulligan(self, hand):
+        return should_mulligan(hand)
 
-def main(argv=None):
-    global draw_multiplier, cards
-    if not argv:
-        argv = sys.argv
-    num_iterations = 500
-    num_turns = 10
-    example = False
+    def mulligan_class(self, card):
+        return mulligan_class(card)
 
-    if len(argv) < 2:
-        print("Need to supply a deck file")
-        return
-    elif len(argv) > 2:
-        if argv[2] == 'example':
-            num_iterations = 1
-            example = True
-        else:
-            num_iterations = int(argv[2])
-        if len(argv) > 3:
-            num_turns = int(argv[3])
+    def should_play(self, env):
+        if self.play_table is None:
+            return should_play(env)
+        return play_by_priorities(env, self.play_table)
 
+    def should_discard(self, env, num):
+        if self.discard_table is None:
+            return should_discard(env, num)
+        return self.discard_table.order(env['hand'], env)[:num]
+
+
+DEFAULT_STRATEGY = Strategy()
+
+
+def parse_deck(lines, verbose=False):
     library = []
     commander = None
+    for line in lines:
+        if line.startswith('SB:'):
+            trash, quantity, *parts = line.split()
+            card_name = ' '.join(parts)
+            commander = copy.copy(cards.get(card_name, FillerCard(name='Filler')))
+            commander.is_commander = True
+            commander.name = card_name
+            continue
+        quantity, *parts = line.split()
+        card_name = ' '.join(parts)
+        card = copy.copy(cards.get(card_name, FillerCard(name='Filler')))
+        if isinstance(card, FillerCard) and verbose:
+            print(line)
+        card.name = card_name
+        # One object per copy so per-game state can be tracked for each copy,
+        # but the objects themselves are never modified during a game.
+        for i in range(int(quantity)):
+            library.append(copy.copy(card))
+    return library, commander
+
+
+def read_deck_lines(deck_path):
+    with open(deck_path) as deck_file:
+        return tuple(deck_file)
+
+
+def load_deck(deck_path, verbose=False):
+    return parse_deck(read_deck_lines(deck_path), verbose)
+
+
+# Worker processes get decks as lines since cards hold closures that can't
+# be pickled, each process parses a given deck once.
+@functools.lru_cache(maxsize=256)
+def cached_deck(deck_lines):
+    return parse_deck(deck_lines)
+
+
+# Every game gets its own random stream derived from the run seed and the
+# game's index, so results don't depend on how the games are split up.
+def game_seed(seed, iteration):
+    return (seed << 32) + iteration
+
+
+# Exact distribution of how the mulligan loop ends: each outcome is the
+# final hand, as counts of each mulligan_class, with the number of
+# mulligans taken and its probability. Hands are dealt one after another
+# off the same shuffle, so every hand's chance is multivariate
+# hypergeometric over what the earlier hands left in the library.
+class MulliganTable:
+    def __init__(self, library, hand_size=7, strategy=DEFAULT_STRATEGY):
+        self.strategy = strategy
+        groups = {}
+        for card in library:
+            groups.setdefault(strategy.mulligan_class(card), []).append(card)
+        self.groups = list(groups.values())
+        self.expansions = {}
+        self.outcomes = sorted(self.expand(tuple(len(group) for group in self.groups), hand_size).items(),
+                               key=lambda outcome: (-outcome[1], outcome[0]))
+        self.cumulative = list(itertools.accumulate(probability for _, probability in self.outcomes))
+
+    def expand(self, remaining, size):
+        key = (remaining, size)
+        if key in self.expansions:
+            return self.expansions[key]
+        size = min(size, sum(remaining))
+        ways = math.comb(sum(remaining), size)
+        results = defaultdict(float)
+        for hand in hand_compositions(remaining, size):
+            probability = math.prod(math.comb(r, k) for r, k in zip(remaining, hand)) / ways
+            representative = [card for group, count in zip(self.groups, hand) for card in group[:count]]
+            if size - 1 > 0 and self.strategy.should_mulligan(representative):
+                left = tuple(r - k for r, k in zip(remaining, hand))
+                for (final, mulligans), p in self.expand(left, size - 1).items():
+                    results[final, mulligans + 1] += probability * p
+            else:
+                results[hand, 0] += probability
+        self.expansions[key] = results
+        return results
+
+    def mulligan_rate(self):
+        return sum(p for (_, mulligans), p in self.outcomes if mulligans > 0)
+
+    def mean_mulligans(self):
+        return sum(p * mulligans for (_, mulligans), p in self.outcomes)
+
+    def mulligan_distribution(self):
+        distribution = Counter()
+        for (_, mulligans), p in self.outcomes:
+            distribution[mulligans] += p
+        return distribution
+
+    # Deals the opening hand straight from the distribution: picks an
+    # outcome, then which cards of each class make up the hand. The rest of
+    # the library is shuffled, as it is after the mulligan loop.
+    def deal(self, env):
+        rng = env['library'].rng
+        index = bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])
+        (counts, mulligans) = self.outcomes[min(index, len(self.outcomes) - 1)][0]
+        hand = []
+        for group, count in zip(self.groups, counts):
+            hand += rng.sample(group, count)
+        rng.shuffle(hand)
+        in_hand = set(hand)
+        env['library'] = Library([card for card in env['library'] if card not in in_hand], rng)
+        env['library'].shuffle()
+        env['hand'] = hand
+        env['mulligans'] = mulligans
+        env['cards_drawn'] = [(card.name, env['turn']) for card in hand]
+        if env['example']:
+            print('Drawing', ', '.join(['{}'] * len(hand)).format(*hand))
+
+    def report(self):
+        print('Exact mulligans: {:.2%} of games mulligan, {:.3f} mulligans per game'.format(
+              self.mulligan_rate(), self.mean_mulligans()))
+        for mulligans, p in sorted(self.mulligan_distribution().items()):
+            print('{} mulligans: {:7.3%}'.format(mulligans, p))
+        labels = []
+        for group in self.groups:
+            names = list(dict.fromkeys(card.name for card in group))
+            labels.append('{} ({} cards)'.format(', '.join(names[:3]) + (', ...' if len(names) > 3 else ''),
+                                                 len(group)))
+        print('\nOpening hands, counts of:')
+        for i, label in enumerate(labels):
+            print('  {}: {}'.format(chr(ord('A') + i), label))
+        for (counts, mulligans), p in self.outcomes:
+            print('{:8.3%} {} with {} mulligans'.format(
+                  p, ' '.join('{}={}'.format(chr(ord('A') + i), count) for i, count in enumerate(counts)),
+                  mulligans))
+
+
+def hand_compositions(remaining, size):
+    if len(remaining) == 0:
+        if size == 0:
+            yield ()
+        return
+    rest = sum(remaining[1:])
+    for count in range(max(0, size - rest), min(remaining[0], size) + 1):
+        for hand in hand_compositions(remaining[1:], size - count):
+            yield (count,) + hand
+
+
+# The turn is split into phases so --profile can time each of them.
+def mulligan_phase(env, opening=None):
+    if opening is not None:
+        opening.deal(env)
+        return
+    env['library'].shuffle()
+    draw_cards(env, 7)
+    mulligan_hands(env, 6)
+
+
+# Mulligans for as long as the strategy wants, to a hand of cards_to_draw
+# cards and one less each time after that. With force the first mulligan is
+# taken whatever the strategy thinks.
+def mulligan_hands(env, cards_to_draw, force=False):
+    saved_cards = []
+    while (force or env['strategy'].should_mulligan(env['hand'])) and cards_to_draw > 0:
+        force = False
+        env['mulligans'] += 1
+        saved_cards += env['hand']
+        env['hand'] = []
+        env['cards_drawn'] = []
+        draw_cards(env, cards_to_draw)
+        cards_to_draw -= 1
+    env['library'].shuffle_in(saved_cards)
+
+
+def upkeep_phase(env):
+    for card in env['played_cards']:
+        for effect in card.turn_effects:
+            effect(env)
+
 
-    with open(argv[1]) as deck_file:
-        for line in deck_file:
-            if line.startswith('SB:'):
-                trash, quantity, *parts = line.split()
-                card_name = ' '.join(parts)
-                commander = cards.get(card_name, FillerCard(name='Filler'))
-                commander.is_commander = True
-                commander.name = card_name
+def draw_phase(env):
+    draw_cards(env, 1)
+
+    if env['example']:
+        print('In Play: ', ', '.join(['{}'] * len(env['played_cards'])).format(*sorted(env['played_cards'],
+                                                                                       key=lambda x: x.name)))
+        print('Hand: ', ', '.join(['{}'] * len(env['hand'])).format(*sorted(env['hand'],
+                                                                            key=lambda x: x.name)))
+
+
+def mana_phase(env):
+    for card in env['played_cards']:
+        card.generate_mana(env)
+
+
+def main_phase(env):
+    for card in env['strategy'].should_play(env):
+        if card not in env['hand'] or not card.can_play(env):
+            continue
+        try:
+            card.play(env)
+        except ValueError:
+            traceback.print_exc()
+            continue
+        card.generate_mana(env)
+        env['played_cards'].append(card)
+        env['hand'].remove(card)
+
+
+def discard_phase(env):
+    to_remove = [card for card in env['hand'] if card.name == 'Draw Spell']
+    for card in to_remove:
+        env['hand'].remove(card)
+    hand_len = len(env['hand'])
+    if hand_len > 7:
+        for card in env['strategy'].should_discard(env, hand_len - 7):
+            try:
+                env['hand'].remove(card)
+            except ValueError:
+                print("Couldn't find card to discard")
                 continue
-            quantity, *parts = line.split()
-            card_name = ' '.join(parts)
-            card = cards.get(card_name, FillerCard(name='Filler'))
-            if isinstance(card, FillerCard):
-                print(line)
-            card.name = card_name
-            for i in range(int(quantity)):
-                library.append(copy.deepcopy(card))
-    print(len(library))
-    generated_mana = []
-    for i in range(num_turns):
-        generated_mana.append([0] * num_iterations)
-    excess_mana = [0.0] * num_turns
-    cards_drawn = []
-    cards_played = []
-    average_mulligans = 0
-    max_mana = 0
-    for iteration in range(num_iterations):
-        env = {
-                'library': copy.deepcopy(library), # noqa
-                'hand': [],
-                'mana_pool': [],
-                'land_plays': 1,
-                'played_cards': [],
-                'cards_drawn': [],
-                'cards_played': [],
-                'turn': 1,
-                'example': example,
-                'mana_generated': 0,
-                'use_delay': True
-              }
-
-        random.shuffle(env['library'])
-        draw_cards(env, 7)
-        saved_cards = []
-        cards_to_draw = 6
-        while should_mulligan(env['hand']) and cards_to_draw > 0:
-            average_mulligans += 1 / num_iterations
-            saved_cards += env['hand']
-            env['hand'] = []
-            env['cards_drawn'] = []
-            draw_cards(env, cards_to_draw)
-            cards_to_draw -= 1
-        env['library'] += saved_cards
-        random.shuffle(env['library'])
-
-        if commander:
-            env['hand'].append(copy.deepcopy(commander))
-
-        for turn in range(num_turns):
-            if len(env['library']) == 0:
+            if env['trace'] is not None:
+                env['trace'].add(TRACE_DISCARD, card.name)
+    if env['example'] and len(to_remove) > 0:
+        print('Discarding: ', ', '.join(['{}'] * len(to_remove)).format(*sorted(to_remove,
+                                                                                key=lambda x: x.name)))
+
+
+def cleanup_phase(env):
+    dead_cards = []
+    for card in env['played_cards']:
+        if not card.survives_turn(env):
+            dead_cards.append(card)
+    for card in dead_cards:
+        env['played_cards'].remove(card)
+        if env['trace'] is not None:
+            env['trace'].add(TRACE_DEATH, card.name)
+        if card.is_commander:
+            env['commander_tax'] += 1
+            env['hand'].append(card)
+
+
+# The library shuffles from a stream of its own, seeded once from rng before
+# anything else uses it. Games on the same seed then draw the same cards for
+# as long as their libraries match, however differently they are played,
+# which is what pairs the games of --compare, --marginal and what_if.
+def library_rng(rng):
+    return random.Random(rng.getrandbits(64))
+
+
+def new_game(library, num_turns, rng, example=False, trace=None, strategy=DEFAULT_STRATEGY):
+    return {
+            'library': Library(library, library_rng(rng)),
+            'hand': [],
+            'mana_pool': ManaPool(),
+            'land_plays': 1,
+            'played_cards': Battlefield(),
+            'cards_drawn': [],
+            'cards_played': [],
+            'turn': 1,
+            'example': example,
+            'mana_generated': 0,
+            'use_delay': True,
+            'draw_multiplier': 1,
+            'rng': rng,
+            'mulligans': 0,
+            'turn_mana': [0] * num_turns,
+            'turn_excess': [0] * num_turns,
+            'turn_land_plays': [0] * num_turns,
+            'delays': {},
+            'extra_play_effects': {},
+            'commander_tax': 0,
+            'effects_version': 0,
+            'trace': trace,
+            'strategy': strategy
+          }
+
+
+# A new game up to the start of the first turn.
+def start_game(library, commander, num_turns, rng, example=False, opening=None, trace=None,
+               strategy=DEFAULT_STRATEGY):
+    env = new_game(library, num_turns, rng, example, trace, strategy)
+    mulligan_phase(env, opening)
+    if trace is not None:
+        trace.add(TRACE_MULLIGANS, None, env['mulligans'])
+    if commander:
+        env['hand'].append(commander)
+    return env
+
+
+def play_game(library, commander, num_turns, rng, example=False, opening=None, trace=None,
+              strategy=DEFAULT_STRATEGY):
+    env = start_game(library, commander, num_turns, rng, example, opening, trace, strategy)
+    play_turns(env, 0, num_turns)
+    return env
+
+
+# Plays turns first + 1 to last (counting from 1), or until the library runs
+# out.
+def play_turns(env, first, last):
+    example = env['example']
+    trace = env['trace']
+    for turn in range(first, last):
+        if len(env['library']) == 0:
+            break
+        env['turn'] = turn + 1
+        env['draw_multiplier'] = 1
+        env['mana_generated'] = 0
+        if example:
+            print('\n{}'.format(env['turn']))
+        if trace is not None:
+            trace.add(TRACE_TURN, None, env['turn'])
+        env['mana_pool'] = ManaPool()
+        env['land_plays'] = 1
+        env['use_delay'] = True
+
+        upkeep_phase(env)
+        draw_phase(env)
+        mana_phase(env)
+        main_phase(env)
+
+        env['turn_excess'][turn] = len(env['mana_pool'])
+        env['turn_mana'][turn] = env['mana_generated']
+
+        discard_phase(env)
+        cleanup_phase(env)
+
+
+def is_spell(name):
+    card = cards.get(name)
+    return (card is None or not card.is_land) and name != "Draw Spell"
+
+
+def spells_per_turn(env, num_turns):
+    spells = [0] * num_turns
+    for name, turn in env['cards_played']:
+        if is_spell(name):
+            spells[turn - 1] += 1
+    return spells
+
+
+def sample_variance(n, total, squares):
+    if n < 2:
+        return float("inf")
+    return max(0, n * squares - total * total) / (n * (n - 1))
+
+
+def histogram_value_at(histogram, index):
+    for value in sorted(histogram):
+        index -= histogram[value]
+        if index < 0:
+            return value
+    raise IndexError(index)
+
+
+# Everything is kept as counts so memory doesn't grow with the number of
+# games. Mana per turn is a small integer, so a histogram gives exact
+# medians and percentiles, and integer sums keep merged results exact no
+# matter how the games were split between workers.
+class SimulationStats:
+    def __init__(self, num_turns, sampling=None):
+        self.num_turns = num_turns
+        # Group sums of a --sampling scheme, see sampling_stats.
+        self.sampling = sampling
+        self.num_games = 0
+        self.mana_histograms = [Counter() for i in range(num_turns)]
+        self.mana_sums = [0] * num_turns
+        self.mana_squares = [0] * num_turns
+        self.excess_mana = [0] * num_turns
+        self.spells_sums = [0] * num_turns
+        self.spells_squares = [0] * num_turns
+        self.cards_drawn = Counter()
+        self.cards_played = Counter()
+        self.mulligans = 0
+        self.mulligan_squares = 0
+        self.max_mana = 0
+
+    def add_game(self, env, group=None):
+        self.num_games += 1
+        for turn, mana in enumerate(env['turn_mana']):
+            self.mana_histograms[turn][mana] += 1
+            self.mana_sums[turn] += mana
+            self.mana_squares[turn] += mana * mana
+            self.excess_mana[turn] += env['turn_excess'][turn]
+        self.max_mana = max(self.max_mana, max(env['turn_mana'], default=0))
+        spells = spells_per_turn(env, self.num_turns)
+        for turn, count in enumerate(spells):
+            self.spells_sums[turn] += count
+            self.spells_squares[turn] += count * count
+        self.cards_drawn.update(env['cards_drawn'])
+        self.cards_played.update(env['cards_played'])
+        self.mulligans += env['mulligans']
+        self.mulligan_squares += env['mulligans'] ** 2
+        if self.sampling is not None:
+            self.sampling.add(group, env['turn_mana'] + spells + [env['mulligans']])
+
+    # Games have to be merged in iteration order for the report to come out
+    # the same as a serial run.
+    def merge(self, other):
+        self.num_games += other.num_games
+        for turn in range(self.num_turns):
+            self.mana_histograms[turn].update(other.mana_histograms[turn])
+            self.mana_sums[turn] += other.mana_sums[turn]
+            self.mana_squares[turn] += other.mana_squares[turn]
+            self.excess_mana[turn] += other.excess_mana[turn]
+            self.spells_sums[turn] += other.spells_sums[turn]
+            self.spells_squares[turn] += other.spells_squares[turn]
+        self.max_mana = max(self.max_mana, other.max_mana)
+        self.cards_drawn.update(other.cards_drawn)
+        self.cards_played.update(other.cards_played)
+        self.mulligans += other.mulligans
+        self.mulligan_squares += other.mulligan_squares
+        if other.sampling is not None:
+            if self.sampling is None:
+                self.sampling = other.sampling.empty()
+            self.sampling.merge(other.sampling)
+
+    # JSON friendly form of the accumulated results. Counters are kept as
+    # lists in insertion order so a restored report comes out the same.
+    def state(self):
+        return {
+            'num_turns': self.num_turns,
+            'num_games': self.num_games,
+            'mana_histograms': [list(histogram.items()) for histogram in self.mana_histograms],
+            'mana_sums': self.mana_sums,
+            'mana_squares': self.mana_squares,
+            'excess_mana': self.excess_mana,
+            'spells_sums': self.spells_sums,
+            'spells_squares': self.spells_squares,
+            'cards_drawn': [[name, turn, count] for (name, turn), count in self.cards_drawn.items()],
+            'cards_played': [[name, turn, count] for (name, turn), count in self.cards_played.items()],
+            'mulligans': self.mulligans,
+            'mulligan_squares': self.mulligan_squares,
+            'max_mana': self.max_mana,
+            'sampling': None if self.sampling is None else self.sampling.state(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls(state['num_turns'])
+        stats.num_games = state['num_games']
+        stats.mana_histograms = [Counter(dict(histogram)) for histogram in state['mana_histograms']]
+        stats.mana_sums = list(state['mana_sums'])
+        stats.mana_squares = list(state['mana_squares'])
+        stats.excess_mana = list(state['excess_mana'])
+        stats.spells_sums = list(state['spells_sums'])
+        stats.spells_squares = list(state['spells_squares'])
+        stats.cards_drawn = Counter({(name, turn): count for name, turn, count in state['cards_drawn']})
+        stats.cards_played = Counter({(name, turn): count for name, turn, count in state['cards_played']})
+        stats.mulligans = state['mulligans']
+        stats.mulligan_squares = state['mulligan_squares']
+        stats.max_mana = state['max_mana']
+        if state.get('sampling') is not None:
+            stats.sampling = sampling_stats_from_state(state['sampling'])
+        return stats
+
+    def median(self, turn):
+        histogram = self.mana_histograms[turn]
+        low = histogram_value_at(histogram, (self.num_games - 1) // 2)
+        high = histogram_value_at(histogram, self.num_games // 2)
+        return low if low == high else (low + high) / 2
+
+    def percentile(self, turn, percent):
+        index = max(0, -(-self.num_games * percent // 100) - 1)
+        return histogram_value_at(self.mana_histograms[turn], index)
+
+    def mean(self, turn):
+        if self.sampling is not None:
+            mean = self.sampling.mean(turn)
+            if mean is not None:
+                return mean
+        return self.mana_sums[turn] / self.num_games
+
+    def pstdev(self, turn):
+        n = self.num_games
+        return ((n * self.mana_squares[turn] - self.mana_sums[turn] ** 2) / (n * n)) ** 0.5
+
+    # Variance of the estimated mean of a measure: index is the measure's
+    # position in the sampling values (mana per turn, spells per turn, then
+    # mulligans). Games are independent unless a --sampling scheme grouped
+    # them.
+    def estimate_variance(self, index, total, squares):
+        if self.sampling is not None:
+            return self.sampling.variance(index)
+        return sample_variance(self.num_games, total, squares) / self.num_games
+
+    # Half widths of normal confidence intervals for the per-game means, z is
+    # the number of standard errors for the wanted confidence.
+    def mean_interval(self, turn, z):
+        return z * self.estimate_variance(turn, self.mana_sums[turn], self.mana_squares[turn]) ** 0.5
+
+    def spells_interval(self, turn, z):
+        return z * self.estimate_variance(self.num_turns + turn, self.spells_sums[turn],
+                                          self.spells_squares[turn]) ** 0.5
+
+    def mulligan_interval(self, z):
+        return z * self.estimate_variance(2 * self.num_turns, self.mulligans, self.mulligan_squares) ** 0.5
+
+    # How many independent games would give the mean mana of the turn as
+    # precisely as the games played did.
+    def effective_games(self, turn):
+        variance = self.estimate_variance(turn, self.mana_sums[turn], self.mana_squares[turn])
+        if variance == 0:
+            return float(self.num_games)
+        return sample_variance(self.num_games, self.mana_sums[turn], self.mana_squares[turn]) / variance
+
+    # Distribution-free interval for the median from the order statistics
+    # around the middle rank.
+    def median_interval(self, turn, z):
+        n = self.num_games
+        spread = z * n ** 0.5 / 2
+        low = max(0, int(n / 2 - spread) - 1)
+        high = min(n - 1, -int(-(n / 2 + spread)))
+        histogram = self.mana_histograms[turn]
+        return histogram_value_at(histogram, low), histogram_value_at(histogram, high)
+
+    # The medians aren't included, they move in whole steps of mana.
+    def converged(self, precision, z):
+        return (all(self.mean_interval(turn, z) <= precision and self.spells_interval(turn, z) <= precision
+                    for turn in range(self.num_turns)) and
+                self.mulligan_interval(z) <= precision)
+
+    def report(self, example=False, confidence=None, out=None):
+        out = out or sys.stdout
+        num_iterations = self.num_games
+        z = None if confidence is None else statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        mana_at_turn = [self.median(turn) for turn in range(self.num_turns)]
+
+        card_stats = defaultdict(lambda: [0, 0, 0, 0, 0, 0])
+        spells_cast = [0] * self.num_turns
+        total_spells_cast = 0
+        for (card, turn), count in self.cards_drawn.items():
+            card_stats[card][0] += turn * count
+            card_stats[card][2] += count
+            card_obj = cards.get(card, FillerCard(name='Filler'))
+            if mana_at_turn[turn - 1] <= len(card_obj.cost):
+                card_stats[card][4] += count
+        for (card, turn), count in self.cards_played.items():
+            card_stats[card][1] += turn * count
+            card_stats[card][3] += count
+            card_obj = cards.get(card, FillerCard(name='Filler'))
+            if mana_at_turn[turn - 1] <= len(card_obj.cost):
+                card_stats[card][5] += count
+            if is_spell(card):
+                spells_cast[turn - 1] += count
+                total_spells_cast += count
+
+        for i in range(self.num_turns):
+            line = 'Turn {:2.0f}: {:3.0f} median, {:3.2f} mean, and {:3.2f} stddev with {:3.2f} mean excess, and {:2.2f} spells cast'.format(i + 1, # noqa
+                   mana_at_turn[i], self.mean(i), self.pstdev(i),
+                   self.excess_mana[i] / num_iterations, spells_cast[i] / num_iterations)
+            if z is not None:
+                line += ' | {:.0%} CI: median [{}, {}], mean \u00b1{:.3f}, spells \u00b1{:.3f}'.format(
+                    confidence, *self.median_interval(i, z), self.mean_interval(i, z), self.spells_interval(i, z))
+            print(line, file=out)
+        print('Max: {:.2f}'.format(self.max_mana), file=out)
+        print('Average spells cast: {:2.2f}'.format(total_spells_cast / num_iterations), file=out)
+        print('\n{:.2f} mean cards drawn'.format(sum(self.cards_drawn.values()) / num_iterations), file=out)
+        if z is not None:
+            print('{:.2f} \u00b1{:.3f} mulligans per game over {} games\n'.format(
+                self.mulligans / num_iterations, self.mulligan_interval(z), num_iterations), file=out)
+        else:
+            print('{:.2f} mulligans per game\n'.format(self.mulligans / num_iterations), file=out)
+        if self.sampling is not None and num_iterations > 1:
+            print('{} sampling, effective games per turn for mean mana: {}\n'.format(
+                  self.sampling.scheme.capitalize(),
+                  ', '.join('{:.0f}'.format(self.effective_games(turn)) for turn in range(self.num_turns))),
+                  file=out)
+        if not example:
+            for card, val in sorted(card_stats.items(), key=lambda x: x[1][5] / max(x[1][4], 1)):
+                play_to_draw = float("inf") if val[2] == 0 else val[3] / val[2] * 100
+                percent_played = min(100, 100 * val[3] / num_iterations)
+                percent_drawn = min(100, 100 * val[2] / num_iterations)
+                draw_on_curve = val[4] / num_iterations
+                play_on_curve = val[5] / num_iterations
+                on_curve_ratio = float("inf") if draw_on_curve == 0 else play_on_curve / draw_on_curve
+                print('{} {} was drawn {:3.0f}% and played {:3.0f}% of games with play/draw ratio {:3.0f}%. Drawn {:3.0f}% and played {:3.0f}% with ratio {:3.0f}% on curve'.format(card, # noqa
+                        ' ' * (30 - len(card)), percent_drawn, percent_played, play_to_draw,
+                        draw_on_curve * 100, play_on_curve * 100, on_curve_ratio * 100), file=out)
+
+
+def simulate_range(library, commander, num_turns, seed, start, stop, example=False,
+                   exact_mulligans=False, strategy=DEFAULT_STRATEGY, sampling='independent'):
+    if exact_mulligans or sampling == 'independent':
+        sampler = None
+        stats = SimulationStats(num_turns)
+    else:
+        sampler = Sampler(sampling, library, seed)
+        stats = SimulationStats(num_turns, sampling_stats(sampler, num_turns))
+    opening = opening_table(library, strategy) if exact_mulligans else None
+    group = None
+    for iteration in range(start, stop):
+        rng = random.Random(game_seed(seed, iteration))
+        if sampler is not None:
+            opening = SampledOpening(sampler, iteration)
+            group = sampler.group(iteration)
+        stats.add_game(play_game(library, commander, num_turns, rng, example, opening,
+                                 strategy=strategy), group)
+    return stats
+
+
+# --sampling schemes. Every game's library shuffles from a stream of its own
+# (library_rng), so runs with the same seed draw the same cards for as long
+# as their libraries match, however differently the games are played.
+#   antithetic: games 2k and 2k + 1 shuffle with mirrored random numbers,
+#     u and 1 - u, from a library sorted mana producers first, so a game
+#     that draws many producers is paired with one that draws few.
+#   stratified: the number of mana producers in the first 7 cards is spread
+#     over the games in proportion to its odds instead of left to chance,
+#     and the results are weighed by those odds.
+SAMPLING_SCHEMES = ['independent', 'antithetic', 'stratified']
+# Smallest probability of a stratum, rarer producer counts are merged with
+# their neighbours so every stratum gets games early on.
+MIN_STRATUM = 0.05
+
+
+def shuffle_seed(seed, index):
+    return 'library {} {}'.format(seed, index)
+
+
+# Mirrors a random stream: random() gives 1 - u for each u of the stream,
+# on the same 2**-53 grid, so it stays below 1.
+class AntitheticRandom:
+    def __init__(self, rng):
+        self.rng = rng
+
+    def random(self):
+        return 1.0 - 2.0 ** -53 - self.rng.random()
+
+    def randrange(self, n):
+        return int(self.random() * n)
+
+
+# Probabilities of each number of mana producers in the first hand_size
+# cards, grouped into strata of at least MIN_STRATUM, as lists of (count,
+# probability).
+def opening_strata(producers, others, hand_size):
+    ways = math.comb(producers + others, hand_size)
+    strata = [[]]
+    for count in range(max(0, hand_size - others), min(producers, hand_size) + 1):
+        if sum(p for _, p in strata[-1]) >= MIN_STRATUM:
+            strata.append([])
+        strata[-1].append((count, math.comb(producers, count) * math.comb(others, hand_size - count) / ways))
+    if len(strata) > 1 and sum(p for _, p in strata[-1]) < MIN_STRATUM:
+        last = strata.pop()
+        strata[-1] += last
+    return strata
+
+
+# Deals each game's library and opening hand for a --sampling scheme, in
+# place of mulligan_phase's shuffle.
+class Sampler:
+    def __init__(self, scheme, library, seed, hand_size=7):
+        self.scheme = scheme
+        self.seed = seed
+        self.hand_size = min(hand_size, len(library))
+        self.producers = [card for card in library if len(card.managen) > 0]
+        self.others = [card for card in library if len(card.managen) == 0]
+        self.ordered = self.producers + self.others
+        self.strata = opening_strata(len(self.producers), len(self.others), self.hand_size)
+        self.cumulative = list(itertools.accumulate(sum(p for _, p in stratum) for stratum in self.strata))
+
+    # Antithetic pairs and strata are the groups the variance is worked out
+    # over. Strata follow the golden ratio sequence, which visits every
+    # stratum in proportion to its probability whatever the range of games.
+    def group(self, iteration):
+        if self.scheme == 'antithetic':
+            return iteration // 2
+        if self.scheme == 'stratified':
+            position = (0.5 + iteration * 0.6180339887498949) % 1.0 * self.cumulative[-1]
+            return min(bisect.bisect(self.cumulative, position), len(self.strata) - 1)
+        return iteration
+
+    def deal(self, env, iteration):
+        if self.scheme == 'antithetic':
+            rng = random.Random(shuffle_seed(self.seed, iteration // 2))
+            if iteration % 2 == 1:
+                rng = AntitheticRandom(rng)
+        else:
+            rng = random.Random(shuffle_seed(self.seed, iteration))
+        env['library'] = Library(self.ordered, rng)
+        if self.scheme != 'stratified':
+            mulligan_phase(env)
+            return
+        stratum = self.strata[self.group(iteration)]
+        count = rng.choices([count for count, _ in stratum], [p for _, p in stratum])[0]
+        hand = rng.sample(self.producers, count) + rng.sample(self.others, self.hand_size - count)
+        rng.shuffle(hand)
+        in_hand = set(hand)
+        env['library'] = Library([card for card in self.ordered if card not in in_hand], rng)
+        env['library'].shuffle()
+        env['hand'] = hand
+        env['cards_drawn'] = [(card.name, env['turn']) for card in hand]
+        if env['trace'] is not None:
+            for card in hand:
+                env['trace'].add(TRACE_DRAW, card.name)
+        if env['example']:
+            print('Drawing', ', '.join(['{}'] * len(hand)).format(*hand))
+        mulligan_hands(env, self.hand_size - 1)
+
+
+# The opening of one game for mulligan_phase.
+class SampledOpening:
+    def __init__(self, sampler, iteration):
+        self.sampler = sampler
+        self.iteration = iteration
+
+    def deal(self, env):
+        self.sampler.deal(env, self.iteration)
+
+
+def sampling_stats(sampler, num_turns):
+    size = 2 * num_turns + 1
+    if sampler.scheme == 'stratified':
+        return StratifiedStats(size, [sum(p for _, p in stratum) for stratum in sampler.strata])
+    return GroupedStats(sampler.scheme, size, 2 if sampler.scheme == 'antithetic' else 1)
+
+
+def sampling_stats_from_state(state):
+    if state['scheme'] == 'stratified':
+        sampling = StratifiedStats(state['size'], state['weights'])
+    else:
+        sampling = GroupedStats(state['scheme'], state['size'], state['group_size'])
+    for key, value in state.items():
+        setattr(sampling, key, value)
+    return sampling
+
+
+# Sums over groups of games that aren't independent of each other, such as
+# antithetic pairs. The variance of a mean comes from how far the group
+# totals spread around group size times the mean. Groups still missing games
+# are kept apart until a merge completes them, so the results don't depend
+# on how the games were split into chunks.
+class GroupedStats:
+    def __init__(self, scheme, size, group_size):
+        self.scheme = scheme
+        self.size = size
+        self.group_size = group_size
+        self.groups = 0
+        self.games = 0
+        self.size_squares = 0
+        self.sums = [0] * size
+        self.cross = [0] * size
+        self.squares = [0] * size
+        # [group, games, totals] of incomplete groups
+        self.partial = []
+
+    def empty(self):
+        return GroupedStats(self.scheme, self.size, self.group_size)
+
+    def add(self, group, values):
+        self.add_partial(group, 1, values)
+
+    def add_partial(self, group, games, totals):
+        for entry in self.partial:
+            if entry[0] == group:
+                entry[1] += games
+                entry[2] = [a + b for a, b in zip(entry[2], totals)]
                 break
-            env['turn'] = turn + 1
-            draw_multiplier = 1
-            env['mana_generated'] = 0
-            if example:
-                print('\n{}'.format(env['turn']))
-            env['mana_pool'] = []
-            env['land_plays'] = 1
-            env['use_delay'] = True
-
-            for card in env['played_cards']:
-                for effect in card.turn_effects:
-                    effect(env)
-
-            draw_cards(env, 1)
-
-            if example:
-                print('In Play: ', ', '.join(['{}'] * len(env['played_cards'])).format(*sorted(env['played_cards'],
-                                                                                               key=lambda x: x.name)))
-                print('Hand: ', ', '.join(['{}'] * len(env['hand'])).format(*sorted(env['hand'],
-                                                                                    key=lambda x: x.name)))
-
-            for card in env['played_cards']:
-                card.generate_mana(env)
-
-            for card in should_play(env):
-                if card not in env['hand'] or not card.can_play(env):
-                    continue
+        else:
+            entry = [group, games, list(totals)]
+            self.partial.append(entry)
+        if entry[1] >= self.group_size:
+            self.partial.remove(entry)
+            self.add_group(entry[1], entry[2], self)
+
+    def add_group(self, games, totals, target):
+        target.groups += 1
+        target.games += games
+        target.size_squares += games * games
+        for index, total in enumerate(totals):
+            target.sums[index] += total
+            target.cross[index] += total * games
+            target.squares[index] += total * total
+
+    def merge(self, other):
+        self.groups += other.groups
+        self.games += other.games
+        self.size_squares += other.size_squares
+        for index in range(self.size):
+            self.sums[index] += other.sums[index]
+            self.cross[index] += other.cross[index]
+            self.squares[index] += other.squares[index]
+        for group, games, totals in other.partial:
+            self.add_partial(group, games, totals)
+
+    def mean(self, index):
+        return None
+
+    # Incomplete groups count as they are.
+    def variance(self, index):
+        complete = self
+        if len(self.partial) > 0:
+            complete = self.empty()
+            complete.merge(self)
+            complete.partial = []
+            for group, games, totals in self.partial:
+                self.add_group(games, totals, complete)
+        if complete.groups < 2:
+            return float("inf")
+        mean = complete.sums[index] / complete.games
+        spread = complete.squares[index] - 2 * mean * complete.cross[index] + mean * mean * complete.size_squares
+        return max(0, spread) * complete.groups / (complete.groups - 1) / (complete.games * complete.games)
+
+    def state(self):
+        return {'scheme': self.scheme, 'size': self.size, 'group_size': self.group_size,
+                'groups': self.groups, 'games': self.games, 'size_squares': self.size_squares,
+                'sums': self.sums, 'cross': self.cross, 'squares': self.squares, 'partial': self.partial}
+
+
+# Sums per stratum. Means are the strata's means weighed by their
+# probabilities, and their variance is weighed the same way.
+class StratifiedStats:
+    scheme = 'stratified'
+
+    def __init__(self, size, weights):
+        self.size = size
+        self.weights = weights
+        self.counts = [0] * len(weights)
+        self.sums = [[0] * size for weight in weights]
+        self.squares = [[0] * size for weight in weights]
+
+    def empty(self):
+        return StratifiedStats(self.size, self.weights)
+
+    def add(self, stratum, values):
+        self.counts[stratum] += 1
+        sums = self.sums[stratum]
+        squares = self.squares[stratum]
+        for index, value in enumerate(values):
+            sums[index] += value
+            squares[index] += value * value
+
+    def merge(self, other):
+        for stratum in range(len(self.weights)):
+            self.counts[stratum] += other.counts[stratum]
+            for index in range(self.size):
+                self.sums[stratum][index] += other.sums[stratum][index]
+                self.squares[stratum][index] += other.squares[stratum][index]
+
+    def mean(self, index):
+        if 0 in self.counts:
+            return None
+        return sum(weight * sums[index] / count
+                   for weight, sums, count in zip(self.weights, self.sums, self.counts))
+
+    def variance(self, index):
+        return sum(weight * weight * sample_variance(count, sums[index], squares[index]) / max(count, 1)
+                   for weight, sums, squares, count in zip(self.weights, self.sums, self.squares, self.counts))
+
+    def state(self):
+        return {'scheme': self.scheme, 'size': self.size, 'weights': self.weights, 'counts': self.counts,
+                'sums': self.sums, 'squares': self.squares}
+
+
+# Plays iterations games of deck, the text of a deck file or its lines, and
+# returns their SimulationStats. Everything a game changes is kept in its
+# env, so simulate() can be called from several threads at once (in
+# parallel on free-threaded Python), each with its own strategy. A seed makes
+# the results reproducible, as with --seed.
+def simulate(deck, iterations=500, turns=10, seed=None, strategy=DEFAULT_STRATEGY, exact_mulligans=False,
+             sampling='independent'):
+    if isinstance(deck, str):
+        deck = deck.splitlines(keepends=True)
+    library, commander = cached_deck(tuple(deck))
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    return simulate_range(library, commander, turns, seed, 0, iterations,
+                          exact_mulligans=exact_mulligans, strategy=strategy, sampling=sampling)
+
+
+@functools.lru_cache(maxsize=16)
+def cached_opening_table(library, strategy):
+    return MulliganTable(library, strategy=strategy)
+
+
+def opening_table(library, strategy=DEFAULT_STRATEGY):
+    return cached_opening_table(tuple(library), strategy)
+
+
+# The batch engine plays every game of a chunk at once with NumPy arrays. It
+# only understands cards without effects, and it follows the built-in
+# strategy: should_mulligan is sampled per hand size and number of mana
+# producers, mana producers are played first by lowest delay, anything else
+# playable is picked at random, and discards go by the amount of mana made.
+# Its random stream differs from the object engine's, so only the statistics
+# match, and results depend on the chunk layout rather than the worker count.
+BATCH_CHUNK_SIZE = 1000
+
+
+def batch_unsupported(library, commander):
+    unsupported = set()
+    if commander is not None:
+        unsupported.add(commander.name)
+    orderings = {}
+    for card in library:
+        if len(card.mana_effects) > 0 or len(card.turn_effects) > 0 or len(card.play_effects) > 0:
+            unsupported.add(card.name)
+        for mana in card.managen:
+            orderings.setdefault(mana_ordering(mana), set()).add(mana)
+    for symbols in orderings.values():
+        if len(symbols) > 1:
+            unsupported.update(card.name for card in library if symbols & set(card.managen))
+    return sorted(unsupported)
+
+
+def batch_mulligan_table(library):
+    producers = [card for card in library if len(card.managen) > 0]
+    others = [card for card in library if len(card.managen) == 0]
+    table = np.zeros((8, 8), dtype=bool)
+    for size in range(8):
+        for lands in range(size + 1):
+            if lands <= len(producers) and size - lands <= len(others):
+                table[size, lands] = should_mulligan(producers[:lands] + others[:size - lands])
+    return table
+
+
+def simulate_batch(library, commander, num_turns, seed, start, stop):
+    games = stop - start
+    rng = np.random.default_rng([seed, start, stop])
+    types = list({card.name: card for card in library}.values())
+    type_index = {card.name: t for t, card in enumerate(types)}
+    slot_type = np.array([type_index[card.name] for card in library])
+    num_cards = len(library)
+    symbols = sorted({mana for card in types for mana in card.managen}, key=mana_ordering)
+    symbol_index = {mana: i for i, mana in enumerate(symbols)}
+    gen = np.zeros((len(types), max(1, len(symbols))), dtype=np.int64)
+    for t, card in enumerate(types):
+        for mana in card.managen:
+            gen[t, symbol_index[mana]] += 1
+    gen_count = gen.sum(1)
+    has_managen = gen_count > 0
+    is_land = np.array([card.is_land for card in types])
+    castable = np.array([not card.is_land and not isinstance(card, FillerCard) for card in types])
+    delay = np.array([card.delay for card in types])
+    dies = np.array([card.survival_chance == 0 for card in types])
+    costs = list({card.cost: None for card in types})
+    cost_index = np.array([costs.index(card.cost) for card in types])
+    part_masks = {part: np.array([can_pay(mana, part) for mana in symbols] or [False])
+                  for cost in costs for part in cost}
+    mulligan_table = batch_mulligan_table(library)
+
+    rows = np.arange(games)
+    positions = np.arange(num_cards)
+    big = num_cards * (int(delay.max(initial=0)) + int(gen_count.max(initial=0)) + 2)
+
+    # Mulligans deal consecutive hands off one shuffle, then whatever isn't in
+    # the kept hand is shuffled again to form the library.
+    dealt = slot_type[np.argsort(rng.random((games, num_cards)), axis=1)]
+    producer_counts = np.concatenate([np.zeros((games, 1), dtype=np.int64),
+                                      np.cumsum(has_managen[dealt], axis=1)], axis=1)
+    hand_start = np.zeros(games, dtype=np.int64)
+    hand_size = np.zeros(games, dtype=np.int64)
+    mulligans = np.zeros(games, dtype=np.int64)
+    kept = np.zeros(games, dtype=bool)
+    offset = 0
+    for size in range(7, 0, -1):
+        size = min(size, num_cards - offset)
+        lands = producer_counts[:, offset + size] - producer_counts[:, offset]
+        keep = ~kept & (~mulligan_table[size, lands] | (size <= 1) | (offset + size >= num_cards))
+        hand_start[keep] = offset
+        hand_size[keep] = size
+        kept |= keep
+        mulligans[~kept] += 1
+        offset += size
+        if kept.all():
+            break
+    in_kept_hand = (positions >= hand_start[:, None]) & (positions < (hand_start + hand_size)[:, None])
+    keys = np.where(in_kept_hand, positions - num_cards, rng.random((games, num_cards)))
+    card_at = np.take_along_axis(dealt, np.argsort(keys, axis=1), axis=1)
+
+    drawn_counts = np.zeros((len(types), num_turns + 1), dtype=np.int64)
+    played_counts = np.zeros((len(types), num_turns + 1), dtype=np.int64)
+    in_hand = positions < hand_size[:, None]
+    np.add.at(drawn_counts[:, 1], card_at[in_hand], 1)
+    drawn = hand_size.copy()
+    on_field = np.zeros((games, num_cards), dtype=bool)
+    delay_left = np.zeros((games, num_cards), dtype=np.int64)
+    alive = np.ones(games, dtype=bool)
+    turn_mana = np.zeros((games, num_turns), dtype=np.int64)
+    turn_excess = np.zeros((games, num_turns), dtype=np.int64)
+    turn_spells = np.zeros((games, num_turns), dtype=np.int64)
+
+    for turn in range(num_turns):
+        alive &= drawn < num_cards
+        if not alive.any():
+            break
+        drawing = rows[alive]
+        in_hand[drawing, drawn[drawing]] = True
+        np.add.at(drawn_counts[:, turn + 1], card_at[drawing, drawn[drawing]], 1)
+        drawn[drawing] += 1
+        land_plays = alive.astype(np.int64)
+
+        producing = on_field & (delay_left == 0) & alive[:, None]
+        delay_left[on_field & (delay_left > 0) & alive[:, None]] -= 1
+        pool = np.zeros((games, gen.shape[1]), dtype=np.int64)
+        for i in range(gen.shape[1]):
+            pool[:, i] = (producing * gen[card_at, i]).sum(1)
+        generated = pool.sum(1)
+
+        while True:
+            payable = np.zeros((games, len(costs)), dtype=bool)
+            remaining = np.zeros((games, len(costs), pool.shape[1]), dtype=np.int64)
+            for c, cost in enumerate(costs):
+                available = pool.copy()
+                ok = np.ones(games, dtype=bool)
+                for part in cost:
+                    candidates = (available > 0) & part_masks[part]
+                    found = candidates.any(1)
+                    choice = candidates.argmax(1)
+                    ok &= found
+                    available[rows[found], choice[found]] -= 1
+                payable[:, c] = ok
+                remaining[:, c] = available
+            playable = in_hand & alive[:, None] & (
+                (is_land[card_at] & (land_plays > 0)[:, None]) |
+                (castable[card_at] & payable[rows[:, None], cost_index[card_at]]))
+            picking = playable.any(1)
+            if not picking.any():
+                break
+            preferred = playable & has_managen[card_at]
+            preferred_key = np.where(preferred, delay[card_at] * num_cards + positions, big)
+            random_key = np.where(playable, rng.random((games, num_cards)), -1)
+            pick = np.where(preferred.any(1), preferred_key.argmin(1), random_key.argmax(1))
+
+            g = rows[picking]
+            p = pick[picking]
+            t = card_at[g, p]
+            land = is_land[t]
+            land_plays[g[land]] -= 1
+            pool[g[~land]] = remaining[g[~land], cost_index[t[~land]]]
+            in_hand[g, p] = False
+            on_field[g, p] = True
+            np.add.at(played_counts[:, turn + 1], t, 1)
+            turn_spells[g[~land], turn] += 1
+            producing = delay[t] == 0
+            delay_left[g, p] = np.maximum(delay[t] - 1, 0)
+            pool[g[producing]] += gen[t[producing]]
+            generated[g[producing]] += gen_count[t[producing]]
+
+        turn_mana[:, turn] = np.where(alive, generated, 0)
+        turn_excess[:, turn] = np.where(alive, pool.sum(1), 0)
+
+        while True:
+            over = alive & (in_hand.sum(1) > 7)
+            if not over.any():
+                break
+            discard_key = np.where(in_hand, gen_count[card_at] * num_cards + positions, big)
+            in_hand[rows[over], discard_key.argmin(1)[over]] = False
+        on_field &= ~(dies[card_at] & alive[:, None])
+
+    stats = SimulationStats(num_turns)
+    stats.num_games = games
+    for turn in range(num_turns):
+        values, counts = np.unique(turn_mana[:, turn], return_counts=True)
+        stats.mana_histograms[turn] = Counter(dict(zip(values.tolist(), counts.tolist())))
+        stats.mana_sums[turn] = int(turn_mana[:, turn].sum())
+        stats.mana_squares[turn] = int((turn_mana[:, turn] ** 2).sum())
+        stats.excess_mana[turn] = int(turn_excess[:, turn].sum())
+        stats.spells_sums[turn] = int(turn_spells[:, turn].sum())
+        stats.spells_squares[turn] = int((turn_spells[:, turn] ** 2).sum())
+    for t, card in enumerate(types):
+        for turn in range(1, num_turns + 1):
+            if drawn_counts[t, turn] > 0:
+                stats.cards_drawn[(card.name, turn)] = int(drawn_counts[t, turn])
+            if played_counts[t, turn] > 0:
+                stats.cards_played[(card.name, turn)] = int(played_counts[t, turn])
+    stats.mulligans = int(mulligans.sum())
+    stats.mulligan_squares = int((mulligans ** 2).sum())
+    stats.max_mana = int(turn_mana.max(initial=0))
+    return stats
+
+
+def simulate_chunk(args):
+    deck_lines, num_turns, seed, start, stop, batch, exact_mulligans, sampling = args
+    library, commander = cached_deck(deck_lines)
+    if batch and numpy_available() and len(batch_unsupported(library, commander)) == 0:
+        return simulate_batch(library, commander, num_turns, seed, start, stop)
+    return simulate_range(library, commander, num_turns, seed, start, stop,
+                          exact_mulligans=exact_mulligans, sampling=sampling)
+
+
+def chunk_ranges(num_iterations, num_chunks):
+    size = -(-num_iterations // num_chunks)
+    return [(start, min(start + size, num_iterations)) for start in range(0, num_iterations, size)]
+
+
+def batch_ranges(batch_size, max_iterations=None, start=0):
+    while max_iterations is None or start < max_iterations:
+        stop = start + batch_size
+        if max_iterations is not None:
+            stop = min(stop, max_iterations)
+        yield start, stop
+        start = stop
+
+
+# Runs (deck lines, start, stop) tasks either in this process or on a worker
+# pool, handing back each task's stats in order. Tasks are consumed lazily so
+# callers can stop early, keeping only a couple of chunks per worker in
+# flight.
+class ChunkRunner:
+    def __init__(self, num_turns, seed, workers=1, batch=False, exact_mulligans=False,
+                 sampling='independent'):
+        self.num_turns = num_turns
+        self.seed = seed
+        self.workers = workers
+        self.batch = batch
+        self.exact_mulligans = exact_mulligans
+        self.sampling = sampling
+        self.executor = None
+        if workers > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    def map(self, function, tasks):
+        if self.executor is None:
+            for task in tasks:
+                yield function(task)
+            return
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(self.executor.submit(function, task))
+            if len(pending) >= self.workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def run(self, tasks):
+        return self.map(simulate_chunk, ((deck_lines, self.num_turns, self.seed, start, stop, self.batch,
+                                          self.exact_mulligans, self.sampling)
+                                         for deck_lines, start, stop in tasks))
+
+    def run_ranges(self, deck_lines, ranges):
+        return self.run((deck_lines, start, stop) for start, stop in ranges)
+
+    # Plays every deck in decks on each game seed of the ranges, handing
+    # back a DeckComparison per range.
+    def compare_ranges(self, decks, ranges):
+        return self.map(compare_chunk, ((decks, self.num_turns, self.seed, start, stop, self.exact_mulligans,
+                                         self.sampling)
+                                        for start, stop in ranges))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Plays games start to num_iterations, start is non-zero when extending
+# earlier results.
+def run_simulation(deck_lines, library, commander, num_iterations, num_turns, seed,
+                   workers=1, example=False, batch=False, start=0, exact_mulligans=False,
+                   sampling='independent'):
+    if example or (workers <= 1 and not batch):
+        return simulate_range(library, commander, num_turns, seed, start, num_iterations, example,
+                              exact_mulligans, sampling=sampling)
+    if batch:
+        ranges = batch_ranges(BATCH_CHUNK_SIZE, num_iterations, start)
+    else:
+        ranges = [(first + start, last + start)
+                  for first, last in chunk_ranges(num_iterations - start, workers * 4)]
+    stats = SimulationStats(num_turns)
+    with ChunkRunner(num_turns, seed, workers, batch, exact_mulligans, sampling) as runner:
+        for chunk in runner.run_ranges(deck_lines, ranges):
+            stats.merge(chunk)
+    return stats
+
+
+# --records writes per-game results in blocks of RECORD_BLOCK_SIZE games.
+# The file starts with an 8 byte magic and a JSON header padded to
+# RECORD_HEADER_SIZE bytes. Space for every game is set aside when the file
+# is created, so each column is stored contiguously for the whole run, game
+# by game and turn by turn, as little-endian unsigned integers, and each
+# block's values are written to their place in it. A column can then be
+# memory mapped as one array (see read_records). The header's column offsets
+# say where each column starts.
+RECORD_MAGIC = b'MTGREC2\n'
+RECORD_HEADER_SIZE = 4096
+RECORD_BLOCK_SIZE = 4096
+# name, bytes per value, one value per turn (rather than per game)
+RECORD_COLUMNS = [
+    ('mana', 4, True),
+    ('excess', 4, True),
+    ('land_plays', 2, True),
+    ('cards_drawn', 2, True),
+    ('cards_played', 2, True),
+    ('mulligans', 1, False),
+]
+
+
+def unsigned_typecode(size):
+    for typecode in 'BHILQ':
+        if array.array(typecode).itemsize == size:
+            return typecode
+    raise ValueError("No array type of {} bytes".format(size))
+
+
+class GameRecords:
+    def __init__(self, num_turns):
+        self.num_turns = num_turns
+        self.num_games = 0
+        self.columns = {name: array.array(unsigned_typecode(size)) for name, size, _ in RECORD_COLUMNS}
+        self.limits = {name: 2 ** (8 * size) - 1 for name, size, _ in RECORD_COLUMNS}
+
+    def add_game(self, env):
+        self.num_games += 1
+        drawn = [0] * self.num_turns
+        for _, turn in env['cards_drawn']:
+            drawn[turn - 1] += 1
+        played = [0] * self.num_turns
+        for _, turn in env['cards_played']:
+            played[turn - 1] += 1
+        for name, values in (('mana', env['turn_mana']), ('excess', env['turn_excess']),
+                             ('land_plays', env['turn_land_plays']), ('cards_drawn', drawn),
+                             ('cards_played', played), ('mulligans', [env['mulligans']])):
+            limit = self.limits[name]
+            self.columns[name].extend(min(value, limit) for value in values)
+
+
+# Games have to be written in order, and at most max_games of them. The
+# header's num_games counts those written, so a run that stops early still
+# leaves a readable file.
+class RecordWriter:
+    def __init__(self, path, num_turns, max_games):
+        self.path = path
+        self.num_turns = num_turns
+        self.max_games = max_games
+        self.num_games = 0
+        self.offsets = {}
+        offset = RECORD_HEADER_SIZE
+        for name, size, per_turn in RECORD_COLUMNS:
+            self.offsets[name] = offset
+            offset += max_games * (num_turns if per_turn else 1) * size
+        self.file = open(path, 'wb')
+        self.file.truncate(offset)
+        self.write_header()
+
+    def write_header(self):
+        header = json.dumps({
+            'version': 2,
+            'num_turns': self.num_turns,
+            'max_games': self.max_games,
+            'num_games': self.num_games,
+            'columns': [{'name': name, 'type': '<u{}'.format(size), 'per_turn': per_turn,
+                         'offset': self.offsets[name]}
+                        for name, size, per_turn in RECORD_COLUMNS],
+        }).encode()
+        self.file.seek(0)
+        self.file.write(RECORD_MAGIC + header.ljust(RECORD_HEADER_SIZE - len(RECORD_MAGIC)))
+
+    # Takes the records of the games that follow those already written.
+    def write(self, records):
+        if self.num_games + records.num_games > self.max_games:
+            raise ValueError("More games than the records file has room for")
+        for name, size, per_turn in RECORD_COLUMNS:
+            values = records.columns[name]
+            width = self.num_turns if per_turn else 1
+            if sys.byteorder == 'big':
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            self.file.seek(self.offsets[name] + self.num_games * width * size)
+            self.file.write(values.tobytes())
+        self.num_games += records.num_games
+
+    def close(self):
+        self.write_header()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Maps a --records file and returns its columns as read-only NumPy memory
+# maps, shaped (games, turns) or (games,) for per-game columns, so nothing
+# is read until it's used. Turn 1 cards_drawn includes the opening hand.
+def read_records(path):
+    if not numpy_available():
+        raise RuntimeError("Reading records needs NumPy")
+    with open(path, 'rb') as records_file:
+        if records_file.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError("{} is not a records file".format(path))
+        header = json.loads(records_file.read(RECORD_HEADER_SIZE - len(RECORD_MAGIC)))
+    num_games = header['num_games']
+    columns = {}
+    for column in header['columns']:
+        shape = (num_games, header['num_turns']) if column['per_turn'] else (num_games,)
+        if num_games == 0:
+            # NumPy can't map an empty range
+            columns[column['name']] = np.zeros(shape, dtype=column['type'])
+        else:
+            columns[column['name']] = np.memmap(path, dtype=column['type'], mode='r',
+                                                offset=column['offset'], shape=shape)
+    return columns
+
+
+# A game's trace is a list of 32 bit events: the event code in the low 4
+# bits, the card's id in the chunk's name table in the next 16 and a value
+# (mana made, turn number, mulligans taken) clipped to 12 bits above that.
+TRACE_TURN = 0
+TRACE_MULLIGANS = 1
+TRACE_DRAW = 2
+TRACE_PLAY = 3
+TRACE_MANA = 4
+TRACE_DISCARD = 5
+TRACE_DEATH = 6
+TRACE_EVENTS = ['Turn', 'Mulligans', 'Draw', 'Play', 'Mana', 'Discard', 'Death']
+TRACE_MAGIC = b'MTGTRC1\n'
+
+
+class GameTrace:
+    def __init__(self, names):
+        self.names = names
+        self.events = array.array(unsigned_typecode(4))
+
+    def add(self, code, name, value=0):
+        name_id = 0
+        if name is not None:
+            name_id = self.names.get(name)
+            if name_id is None:
+                name_id = self.names[name] = len(self.names) + 1
+        self.events.append(code | name_id << 4 | min(value, 4095) << 20)
+
+    def decoded(self):
+        return decode_trace(self.events, {name_id: name for name, name_id in self.names.items()})
+
+
+def decode_trace(events, names):
+    return [(event & 15, names.get(event >> 4 & 65535), event >> 20) for event in events]
+
+
+def describe_event(event):
+    code, name, value = event
+    if code in (TRACE_TURN, TRACE_MULLIGANS):
+        return '{} {}'.format(TRACE_EVENTS[code], value)
+    if code == TRACE_MANA:
+        return '{} {} from {}'.format(TRACE_EVENTS[code], value, name)
+    return '{} {}'.format(TRACE_EVENTS[code], name)
+
+
+# The traced games of one chunk, sharing a name table.
+class TraceChunk:
+    def __init__(self):
+        self.names = {}
+        self.games = []
+
+    def game(self, iteration):
+        trace = GameTrace(self.names)
+        self.games.append((iteration, trace))
+        return trace
+
+
+# --trace files start with a magic and a length prefixed JSON header with
+# the deck, seed and settings needed to replay any game. Then come the
+# chunks: a length prefixed JSON list of card names, the number of games,
+# and for each game its iteration, its number of events and the events.
+class TraceWriter:
+    def __init__(self, path, header):
+        self.file = open(path, 'wb')
+        encoded = json.dumps(header).encode()
+        self.file.write(TRACE_MAGIC + struct.pack('<I', len(encoded)) + encoded)
+
+    def write(self, chunk):
+        names = json.dumps(sorted(chunk.names, key=chunk.names.get)).encode()
+        self.file.write(struct.pack('<I', len(names)) + names + struct.pack('<I', len(chunk.games)))
+        for iteration, trace in chunk.games:
+            events = trace.events
+            if sys.byteorder == 'big':
+                events = array.array(events.typecode, events)
+                events.byteswap()
+            self.file.write(struct.pack('<QI', iteration, len(events)) + events.tobytes())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Returns the header of a --trace file and a generator of (iteration,
+# events) for the games in it, with events as (code, card name, value).
+def read_trace(path):
+    trace_file = open(path, 'rb')
+    if trace_file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        trace_file.close()
+        raise ValueError("{} is not a trace file".format(path))
+    header = json.loads(trace_file.read(struct.unpack('<I', trace_file.read(4))[0]))
+
+    def games():
+        with trace_file:
+            while True:
+                prefix = trace_file.read(4)
+                if len(prefix) < 4:
+                    return
+                names = json.loads(trace_file.read(struct.unpack('<I', prefix)[0]))
+                names = {name_id: name for name_id, name in enumerate(names, 1)}
+                for _ in range(struct.unpack('<I', trace_file.read(4))[0]):
+                    iteration, length = struct.unpack('<QI', trace_file.read(12))
+                    events = array.array(unsigned_typecode(4), trace_file.read(4 * length))
+                    if sys.byteorder == 'big':
+                        events.byteswap()
+                    yield iteration, decode_trace(events, names)
+    return header, games()
+
+
+# Parses game selections like "0-99,1234" into half open ranges.
+def parse_game_ranges(spec):
+    ranges = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        ranges.append((int(first), int(last or first) + 1))
+    return tuple(ranges)
+
+
+def record_chunk(args):
+    deck_lines, num_turns, seed, start, stop, exact_mulligans, records, trace_games = args
+    library, commander = cached_deck(deck_lines)
+    opening = opening_table(library) if exact_mulligans else None
+    stats = SimulationStats(num_turns)
+    game_records = GameRecords(num_turns) if records else None
+    traces = TraceChunk() if trace_games is not None else None
+    for iteration in range(start, stop):
+        trace = None
+        if traces is not None and any(first <= iteration < last for first, last in trace_games):
+            trace = traces.game(iteration)
+        env = play_game(library, commander, num_turns, random.Random(game_seed(seed, iteration)),
+                        opening=opening, trace=trace)
+        stats.add_game(env)
+        if game_records is not None:
+            game_records.add_game(env)
+    return stats, game_records, traces
+
+
+# Like run_simulation, but also streams every game's results to
+# records_path and the traces of the trace_games ranges (every game when
+# None) to trace_path. Only a couple of blocks per worker are held in
+# memory at once.
+def record_simulation(deck_lines, num_iterations, num_turns, seed, workers=1, exact_mulligans=False,
+                      records_path=None, trace_path=None, trace_games=None):
+    if trace_path is not None and trace_games is None:
+        trace_games = ((0, num_iterations),)
+    stats = SimulationStats(num_turns)
+    tasks = ((deck_lines, num_turns, seed, start, stop, exact_mulligans, records_path is not None,
+              trace_games if trace_path is not None else None)
+             for start, stop in batch_ranges(RECORD_BLOCK_SIZE, num_iterations))
+    with contextlib.ExitStack() as stack:
+        runner = stack.enter_context(ChunkRunner(num_turns, seed, workers))
+        writer = tracer = None
+        if records_path is not None:
+            writer = stack.enter_context(RecordWriter(records_path, num_turns, num_iterations))
+        if trace_path is not None:
+            tracer = stack.enter_context(TraceWriter(trace_path, {
+                'version': 1, 'seed': seed, 'num_turns': num_turns,
+                'exact_mulligans': exact_mulligans, 'deck': list(deck_lines)}))
+        for chunk, records, traces in runner.map(record_chunk, tasks):
+            if writer is not None:
+                writer.write(records)
+            if tracer is not None:
+                tracer.write(traces)
+            stats.merge(chunk)
+    return stats
+
+
+# Plays one game of a --trace file again from its seed with the example
+# narrative, and checks it against the recorded events if it was traced.
+def replay_game(path, iteration):
+    header, games = read_trace(path)
+    recorded = None
+    for game_iteration, events in games:
+        if game_iteration == iteration:
+            recorded = events
+            break
+    games.close()
+    library, commander = parse_deck(header['deck'])
+    opening = opening_table(library) if header['exact_mulligans'] else None
+    trace = GameTrace({})
+    rng = random.Random(game_seed(header['seed'], iteration))
+    play_game(library, commander, header['num_turns'], rng, example=True, opening=opening, trace=trace)
+    replayed = trace.decoded()
+    print()
+    if recorded is None:
+        print("Game {} wasn't traced, replayed it from its seed".format(iteration))
+    elif recorded == replayed:
+        print("Replay of game {} matches its trace, {} events".format(iteration, len(recorded)))
+    else:
+        for index, (old, new) in enumerate(zip(recorded + [None], replayed + [None])):
+            if old != new:
+                break
+        print("Replay of game {} differs from its trace at event {}: recorded {}, replayed {}".format(
+              iteration, index, 'nothing' if old is None else describe_event(old),
+              'nothing' if new is None else describe_event(new)))
+
+
+# Runs batches until the confidence intervals of every turn's mean mana and
+# spells cast, and of the mulligans per game, are within precision, the time
+# budget runs out or max_iterations is reached.
+def run_until_converged(deck_lines, num_turns, seed, precision=None,
+                        confidence=0.95, time_budget=None, max_iterations=None,
+                        batch_size=1000, workers=1, batch=False, exact_mulligans=False,
+                        sampling='independent'):
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    stats = SimulationStats(num_turns)
+    reason = 'iteration limit reached'
+    with ChunkRunner(num_turns, seed, workers, batch, exact_mulligans, sampling) as runner:
+        for chunk in runner.run_ranges(deck_lines, batch_ranges(batch_size, max_iterations)):
+            stats.merge(chunk)
+            if precision is not None and stats.converged(precision, z):
+                reason = 'precision reached'
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                reason = 'time budget used'
+                break
+    return stats, reason
+
+
+# Bump when the engine changes results in a way the cache key can't see.
+CACHE_VERSION = 2
+CACHED_SOURCES = ['library_rng', 'new_game', 'should_mulligan', 'should_play', 'should_discard',
+                  'PLAY_PRIORITIES', 'DISCARD_PRIORITIES', 'rules_signature', 'PriorityTable',
+                  'card_property', 'PlayTracker', 'play_by_priorities', 'Strategy', 'Card',
+                  'FillerCard', 'ManaPool', 'pay_cost', 'can_pay', 'draw_cards', 'play_game',
+                  'mulligan_phase', 'upkeep_phase', 'draw_phase', 'mana_phase', 'main_phase',
+                  'discard_phase', 'cleanup_phase', 'game_seed', 'simulate_range', 'simulate_batch',
+                  'SimulationStats', 'mulligan_class', 'MulliganTable', 'Battlefield', 'Library',
+                  'Sampler', 'AntitheticRandom', 'opening_strata', 'SampledOpening', 'GroupedStats',
+                  'StratifiedStats']
+
+
+# Source of a function plus whatever its closure captured, so two cards
+# built by the same factory with different arguments differ. Dicts and sets
+# in closures are caches and counters filled in as games run (such as the
+# priority keys of add_effect_spell), not definitions, so they're left out,
+# and functions wrapped by --profile count as the function they wrap. The
+# fingerprint then stays the same for the whole life of the process.
+def source_fingerprint(value, seen=None):
+    if seen is None:
+        seen = set()
+    if callable(value):
+        value = inspect.unwrap(value)
+    if isinstance(value, (list, tuple)):
+        return [source_fingerprint(item, seen) for item in value]
+    if isinstance(value, dict):
+        return [(key, source_fingerprint(item, seen)) for key, item in value.items()]
+    if not callable(value):
+        return repr(value)
+    if id(value) in seen:
+        return value.__qualname__
+    seen.add(id(value))
+    try:
+        parts = [inspect.getsource(value)]
+    except (OSError, TypeError):
+        parts = [getattr(value, '__qualname__', repr(value))]
+    for cell in getattr(value, '__closure__', None) or ():
+        if not isinstance(cell.cell_contents, (dict, set)):
+            parts.append(source_fingerprint(cell.cell_contents, seen))
+    return parts
+
+
+def card_fingerprint(card):
+    return [type(card).__name__, card.name, card.cost, card.managen, card.delay, card.is_land,
+            card.survival_chance, card.is_commander,
+            source_fingerprint([card.play_effects, card.turn_effects, card.mana_effects])]
+
+
+def cache_key(library, commander, num_turns, seed, batch, exact_mulligans=False, sampling='independent'):
+    module = sys.modules[__name__]
+    definitions = {}
+    for card in library + ([commander] if commander else []):
+        if card.name not in definitions:
+            definitions[card.name] = card_fingerprint(card)
+    parts = [CACHE_VERSION, [card.name for card in library], commander and commander.name,
+             sorted(definitions.items()), [source_fingerprint(getattr(module, name)) for name in CACHED_SOURCES],
+             num_turns, seed, batch, exact_mulligans, sampling]
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+# Directory of JSON encoded SimulationStats, one file per cache key. Hits
+# touch the file and the least recently used files are removed once the
+# directory grows past max_bytes.
+class ResultCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, key):
+        try:
+            with open(self.path(key)) as cache_file:
+                entry = json.load(cache_file)
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            return None
+        if entry.get('version') != CACHE_VERSION:
+            return None
+        return SimulationStats.from_state(entry['stats'])
+
+    def store(self, key, stats):
+        path = self.path(key)
+        with open(path + '.tmp', 'w') as cache_file:
+            json.dump({'version': CACHE_VERSION, 'stats': stats.state()}, cache_file)
+        os.replace(path + '.tmp', path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# Games are seeded by their iteration, so cached results for the first n
+# games can be extended by playing games n onwards. With the batch engine,
+# where chunks are seeded by their range, the extended results only match a
+# fresh run statistically.
+def cached_simulation(cache, deck_lines, library, commander, num_iterations, num_turns, seed,
+                      workers=1, batch=False, exact_mulligans=False, sampling='independent'):
+    use_batch = batch and numpy_available() and len(batch_unsupported(library, commander)) == 0
+    key = cache_key(library, commander, num_turns, seed, use_batch, exact_mulligans and not use_batch,
+                    sampling)
+    stats = cache.load(key)
+    if stats is not None and stats.num_games == num_iterations:
+        print('Using {} cached games'.format(stats.num_games))
+        return stats
+    if stats is not None and stats.num_games < num_iterations:
+        print('Extending {} cached games'.format(stats.num_games))
+        stats.merge(run_simulation(deck_lines, library, commander, num_iterations, num_turns, seed,
+                                   workers, batch=batch, start=stats.num_games,
+                                   exact_mulligans=exact_mulligans, sampling=sampling))
+        cache.store(key, stats)
+        return stats
+    fresh = run_simulation(deck_lines, library, commander, num_iterations, num_turns, seed,
+                           workers, batch=batch, exact_mulligans=exact_mulligans, sampling=sampling)
+    if stats is None:
+        cache.store(key, fresh)
+    return fresh
+
+
+CHECKPOINT_CHUNK_SIZE = 1000
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, key, seed, stats):
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump({'version': CACHE_VERSION, 'key': key, 'seed': seed, 'stats': stats.state()},
+                  checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+
+# Like run_simulation, but plays the games in chunks and saves the stats of
+# the games played so far to path every interval seconds, when the run ends
+# and when it is interrupted. Games are seeded by their iteration, so the
+# number of games played is all the RNG state a checkpoint needs. With
+# resume, play continues after the games in the checkpoint, giving the same
+# results as a run that was never stopped. Returns None if the checkpoint
+# is from a different deck, engine or settings.
+def checkpointed_simulation(path, deck_lines, library, commander, num_iterations, num_turns, seed,
+                            workers=1, batch=False, exact_mulligans=False, resume=False, interval=60,
+                            sampling='independent'):
+    use_batch = batch and numpy_available() and len(batch_unsupported(library, commander)) == 0
+    key = cache_key(library, commander, num_turns, seed, use_batch, exact_mulligans and not use_batch,
+                    sampling)
+    stats = SimulationStats(num_turns)
+    checkpoint = read_checkpoint(path) if resume else None
+    if resume and checkpoint is None:
+        print("No checkpoint in {}, starting from the first game".format(path))
+    elif checkpoint is not None:
+        if checkpoint.get('version') != CACHE_VERSION or checkpoint['key'] != key:
+            print("The checkpoint in {} is for a different deck, engine or settings".format(path))
+            return None
+        stats = SimulationStats.from_state(checkpoint['stats'])
+        if stats.num_games > num_iterations:
+            print("The checkpoint already has {} games".format(stats.num_games))
+            return None
+        print("Resuming after {} games".format(stats.num_games))
+    chunk_size = BATCH_CHUNK_SIZE if use_batch else CHECKPOINT_CHUNK_SIZE
+    last_save = time.monotonic()
+    try:
+        with ChunkRunner(num_turns, seed, workers, batch, exact_mulligans, sampling) as runner:
+            ranges = batch_ranges(chunk_size, num_iterations, stats.num_games)
+            for chunk in runner.run_ranges(deck_lines, ranges):
+                stats.merge(chunk)
+                if time.monotonic() - last_save >= interval:
+                    write_checkpoint(path, key, seed, stats)
+                    last_save = time.monotonic()
+    finally:
+        write_checkpoint(path, key, seed, stats)
+    return stats
+
+
+# Distributed runs: a coordinator (--serve) splits the games into chunks and
+# hands them out over TCP to workers (--connect) on any number of hosts.
+# Messages are lines of JSON: a task holds the deck lines, settings and the
+# range of games, and the reply holds that chunk's SimulationStats state.
+# Games are seeded by their iteration, so the merged stats are the same as
+# those of a run in one process, whichever worker played each chunk.
+DISTRIBUTED_CHUNK_SIZE = 1000
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host, int(port)
+
+
+def send_message(stream, message):
+    stream.write(json.dumps(message).encode() + b'\n')
+    stream.flush()
+
+
+def receive_message(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError('connection closed')
+    return json.loads(line)
+
+
+# Chunks waiting to be played, out with workers and finished. A chunk whose
+# worker disconnects goes back to the front of the queue, and once nothing
+# is waiting, chunks that have been out for longer than timeout are handed
+# to idle workers as well. The first result for a chunk is kept. workers
+# counts the connected workers.
+class ChunkQueue:
+    def __init__(self, ranges, timeout):
+        self.ranges = list(ranges)
+        self.timeout = timeout
+        self.pending = collections.deque(self.ranges)
+        self.running = {}
+        self.results = {}
+        self.workers = 0
+        self.idle_since = time.monotonic()
+        self.condition = threading.Condition()
+
+    def connected(self, change):
+        with self.condition:
+            self.workers += change
+            if self.workers == 0:
+                self.idle_since = time.monotonic()
+            self.condition.notify_all()
+
+    def finished(self):
+        return len(self.results) == len(self.ranges)
+
+    # The next chunk to play, or None once every chunk is done.
+    def take(self):
+        with self.condition:
+            while not self.finished():
+                if self.pending:
+                    chunk = self.pending.popleft()
+                    self.running[chunk] = time.monotonic()
+                    return chunk
+                now = time.monotonic()
+                late = [chunk for chunk, started in self.running.items() if now - started >= self.timeout]
+                if late:
+                    chunk = min(late, key=self.running.get)
+                    self.running[chunk] = now
+                    return chunk
+                self.condition.wait(1)
+            return None
+
+    def failed(self, chunk):
+        with self.condition:
+            if chunk in self.running and chunk not in self.results:
+                del self.running[chunk]
+                self.pending.appendleft(chunk)
+                self.condition.notify_all()
+
+    def done(self, chunk, state):
+        with self.condition:
+            self.results.setdefault(chunk, state)
+            self.running.pop(chunk, None)
+            self.condition.notify_all()
+
+    # Waits for every chunk, returns False if no worker was connected for
+    # idle_timeout seconds before that.
+    def wait(self, idle_timeout=None):
+        with self.condition:
+            while not self.finished():
+                if (idle_timeout is not None and self.workers == 0 and
+                        time.monotonic() - self.idle_since >= idle_timeout):
+                    return False
+                self.condition.wait(1)
+            return True
+
+
+# A reply that isn't the stats of the chunk that was sent counts as a
+# failure, the worker is dropped and the chunk handed out again.
+def serve_worker(connection, queue, task):
+    queue.connected(1)
+    try:
+        # Closing the stream flushes it, which fails if the worker is gone.
+        with contextlib.suppress(OSError), connection, connection.makefile('rwb') as stream:
+            while True:
+                chunk = queue.take()
+                if chunk is None:
+                    with contextlib.suppress(OSError):
+                        send_message(stream, {'done': True})
+                    return
                 try:
-                    card.play(env)
-                except ValueError:
-                    traceback.print_exc()
-                    continue
-                card.generate_mana(env)
-                env['played_cards'].append(card)
-                env['hand'].remove(card)
+                    send_message(stream, dict(task, start=chunk[0], stop=chunk[1]))
+                    reply = receive_message(stream)
+                    stats = SimulationStats.from_state(reply['stats'])
+                    if (reply['start'], reply['stop']) != chunk or stats.num_games != chunk[1] - chunk[0]:
+                        raise ValueError('reply for the wrong chunk')
+                except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                    queue.failed(chunk)
+                    return
+                queue.done(chunk, stats)
+    finally:
+        queue.connected(-1)
+
+
+# Plays num_iterations games on the workers that connect to address, merging
+# the chunks in order once they are all back. Gives up and returns None if
+# no worker is connected for idle_timeout seconds.
+def distributed_simulation(address, deck_lines, num_iterations, num_turns, seed, exact_mulligans=False,
+                           sampling='independent', timeout=300, chunk_size=DISTRIBUTED_CHUNK_SIZE,
+                           idle_timeout=300):
+    queue = ChunkQueue(batch_ranges(chunk_size, num_iterations), timeout)
+    task = {'deck': list(deck_lines), 'num_turns': num_turns, 'seed': seed,
+            'exact_mulligans': exact_mulligans, 'sampling': sampling}
+    connections = []
+
+    def accept(server):
+        while True:
+            try:
+                connection, peer = server.accept()
+            except OSError:
+                return
+            print('Worker connected from {}:{}'.format(*peer[:2]))
+            connections.append(connection)
+            threading.Thread(target=serve_worker, args=(connection, queue, task), daemon=True).start()
+
+    with socket.create_server(address) as server:
+        print('Waiting for workers on {}:{}'.format(*server.getsockname()[:2]))
+        threading.Thread(target=accept, args=(server,), daemon=True).start()
+        finished = queue.wait(idle_timeout)
+    # Workers still playing a chunk that was finished elsewhere are let go.
+    for connection in connections:
+        with contextlib.suppress(OSError):
+            connection.shutdown(socket.SHUT_RDWR)
+    if not finished:
+        print('No worker connected for {:g} seconds, {} of {} chunks played'.format(
+              idle_timeout, len(queue.results), len(queue.ranges)))
+        return None
+    stats = SimulationStats(num_turns)
+    for chunk in queue.ranges:
+        stats.merge(queue.results[chunk])
+    return stats
+
+
+# Plays the chunks a coordinator hands out until it says it's done or goes
+# away. Waits for the coordinator to start if it isn't listening yet.
+def run_worker(address, retry=1.0):
+    while True:
+        try:
+            connection = socket.create_connection(address)
+            break
+        except ConnectionRefusedError:
+            time.sleep(retry)
+    chunks = 0
+    with contextlib.suppress(OSError), connection, connection.makefile('rwb') as stream:
+        while True:
+            try:
+                message = receive_message(stream)
+            except (OSError, ValueError):
+                break
+            if message.get('done'):
+                break
+            stats = simulate_chunk((tuple(message['deck']), message['num_turns'], message['seed'],
+                                    message['start'], message['stop'], False, message['exact_mulligans'],
+                                    message['sampling']))
+            try:
+                send_message(stream, {'start': message['start'], 'stop': message['stop'],
+                                      'stats': stats.state()})
+            except OSError:
+                break
+            chunks += 1
+    return chunks
+
+
+def run_workers(address, workers=1):
+    if workers <= 1:
+        chunks = run_worker(address)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = sum(executor.map(run_worker, [address] * workers))
+    print('Played {} chunks for {}:{}'.format(chunks, *address))
+
+
+# Differences between a variant and the baseline deck, game by game. Both
+# play the same game seeds and, with the library's own stream, draw the same
+# cards for as long as their libraries match (common random numbers), so the
+# spread of the differences is usually much smaller than that of either
+# deck's results.
+class PairedStats:
+    def __init__(self, num_turns):
+        self.num_turns = num_turns
+        self.num_games = 0
+        self.mana_sums = [0] * num_turns
+        self.mana_squares = [0] * num_turns
+        self.spells_sums = [0] * num_turns
+        self.spells_squares = [0] * num_turns
+        # Differences in mana and spells over the whole game
+        self.total_sums = [0, 0]
+        self.total_squares = [0, 0]
+
+    def add_pair(self, env, baseline_env):
+        self.num_games += 1
+        spells = spells_per_turn(env, self.num_turns)
+        baseline_spells = spells_per_turn(baseline_env, self.num_turns)
+        totals = [0, 0]
+        for turn in range(self.num_turns):
+            mana = env['turn_mana'][turn] - baseline_env['turn_mana'][turn]
+            self.mana_sums[turn] += mana
+            self.mana_squares[turn] += mana * mana
+            count = spells[turn] - baseline_spells[turn]
+            self.spells_sums[turn] += count
+            self.spells_squares[turn] += count * count
+            totals[0] += mana
+            totals[1] += count
+        for index, total in enumerate(totals):
+            self.total_sums[index] += total
+            self.total_squares[index] += total * total
+
+    def merge(self, other):
+        self.num_games += other.num_games
+        for index in range(2):
+            self.total_sums[index] += other.total_sums[index]
+            self.total_squares[index] += other.total_squares[index]
+        for turn in range(self.num_turns):
+            self.mana_sums[turn] += other.mana_sums[turn]
+            self.mana_squares[turn] += other.mana_squares[turn]
+            self.spells_sums[turn] += other.spells_sums[turn]
+            self.spells_squares[turn] += other.spells_squares[turn]
+
+    # Mean difference and the two sided p-value of it being zero.
+    def difference(self, sums, squares, turn):
+        mean = sums[turn] / self.num_games
+        variance = sample_variance(self.num_games, sums[turn], squares[turn])
+        if variance == 0:
+            return mean, 1.0 if mean == 0 else 0.0
+        z = mean / (variance / self.num_games) ** 0.5
+        return mean, 2 * (1 - statistics.NormalDist().cdf(abs(z)))
+
+    def mana_difference(self, turn):
+        return self.difference(self.mana_sums, self.mana_squares, turn)
+
+    def spells_difference(self, turn):
+        return self.difference(self.spells_sums, self.spells_squares, turn)
+
+    def total_mana_difference(self):
+        return self.difference(self.total_sums, self.total_squares, 0)
+
+    def total_spells_difference(self):
+        return self.difference(self.total_sums, self.total_squares, 1)
+
+
+class DeckComparison:
+    def __init__(self, num_decks, num_turns):
+        self.stats = [SimulationStats(num_turns) for i in range(num_decks)]
+        self.paired = [PairedStats(num_turns) for i in range(num_decks)]
+
+    def merge(self, other):
+        for stats, other_stats in zip(self.stats, other.stats):
+            stats.merge(other_stats)
+        for paired, other_paired in zip(self.paired, other.paired):
+            paired.merge(other_paired)
+
+    def report(self, names, confidence=0.95):
+        width = max(24, max(len(name) for name in names) + 2)
+        for title, values, difference in (
+                ('Mean mana', lambda stats, turn: stats.mean(turn), PairedStats.mana_difference),
+                ('Spells cast', lambda stats, turn: stats.spells_sums[turn] / stats.num_games,
+                 PairedStats.spells_difference)):
+            print('\n{} per turn, differences against {} ({} games each, * p < {:g})'.format(
+                  title, names[0], self.stats[0].num_games, round(1 - confidence, 6)))
+            print('Turn ' + ''.join('{:>{}}'.format(name, width) for name in names))
+            for turn in range(len(self.stats[0].mana_sums)):
+                cells = ['{:.2f}'.format(values(self.stats[0], turn))]
+                for stats, paired in zip(self.stats[1:], self.paired[1:]):
+                    mean, p = difference(paired, turn)
+                    cells.append('{:.2f} {:+.2f} p={:.3f}{}'.format(values(stats, turn), mean, p,
+                                                                    '*' if p < 1 - confidence else ' '))
+                print('{:4} '.format(turn + 1) + ''.join('{:>{}}'.format(cell, width) for cell in cells))
+
+
+def compare_chunk(args):
+    decks, num_turns, seed, start, stop, exact_mulligans, sampling = args
+    parsed = [cached_deck(deck_lines) for deck_lines in decks]
+    openings = [opening_table(library) if exact_mulligans else None for library, commander in parsed]
+    comparison = DeckComparison(len(decks), num_turns)
+    samplers = [None] * len(decks)
+    if sampling != 'independent' and not exact_mulligans:
+        samplers = [Sampler(sampling, library, seed) for library, commander in parsed]
+        for stats, sampler in zip(comparison.stats, samplers):
+            stats.sampling = sampling_stats(sampler, num_turns)
+    for iteration in range(start, stop):
+        baseline_env = None
+        for index, (library, commander) in enumerate(parsed):
+            rng = random.Random(game_seed(seed, iteration))
+            opening = openings[index]
+            group = None
+            if samplers[index] is not None:
+                opening = SampledOpening(samplers[index], iteration)
+                group = samplers[index].group(iteration)
+            env = play_game(library, commander, num_turns, rng, opening=opening)
+            comparison.stats[index].add_game(env, group)
+            if baseline_env is None:
+                baseline_env = env
+            else:
+                comparison.paired[index].add_pair(env, baseline_env)
+    return comparison
+
+
+# Marginal value of the cards in a deck: for each distinct card the deck is
+# played with one copy swapped for Filler, on the same game seeds as the
+# full deck, so what the card adds is measured game by game. The Filler
+# takes the place of the removed copy, so both libraries shuffle alike.
+def removal_variants(deck_lines):
+    library, commander = cached_deck(deck_lines)
+    known = {card.name for card in library if not isinstance(card, FillerCard)}
+    names = []
+    variants = []
+    for index, line in enumerate(deck_lines):
+        if line.startswith('SB:'):
+            continue
+        quantity, *parts = line.split()
+        name = ' '.join(parts)
+        if name not in known or name in names or int(quantity) < 1:
+            continue
+        swapped = ('1 Filler\n',)
+        if int(quantity) > 1:
+            swapped = ('{} {}\n'.format(int(quantity) - 1, name),) + swapped
+        names.append(name)
+        variants.append(deck_lines[:index] + swapped + deck_lines[index + 1:])
+    return names, variants
+
+
+# Every variant plays each chunk of games with the full deck, and the chunks
+# are spread over the workers.
+def marginal_values(deck_lines, num_iterations, num_turns, seed, workers=1, exact_mulligans=False,
+                    sampling='independent'):
+    names, variants = removal_variants(deck_lines)
+    comparison = DeckComparison(len(variants) + 1, num_turns)
+    with ChunkRunner(num_turns, seed, workers, exact_mulligans=exact_mulligans, sampling=sampling) as runner:
+        decks = (tuple(deck_lines),) + tuple(variants)
+        for chunk in runner.compare_ranges(decks, chunk_ranges(num_iterations, max(1, workers) * 4)):
+            comparison.merge(chunk)
+    return names, comparison
+
+
+# Ranked from the card that adds the least mana over the game to the one that
+# adds the most, so the first cards listed are the ones to cut.
+def report_marginal_values(deck_lines, names, comparison, confidence=0.95):
+    counts, extra_lines = split_deck(deck_lines)
+    num_turns = comparison.stats[0].num_turns
+    rows = []
+    for name, paired in zip(names, comparison.paired[1:]):
+        mana, p = paired.total_mana_difference()
+        spells, spells_p = paired.total_spells_difference()
+        per_turn = [0.0 - paired.mana_difference(turn)[0] for turn in range(num_turns)]
+        rows.append((0.0 - mana, 0.0 - spells, name, p, per_turn))
+    rows.sort(key=lambda row: row[:2])
+    print('\nValue of one copy of each card, from swapping it for Filler ({} games, * p < {:g})'.format(
+          comparison.stats[0].num_games, round(1 - confidence, 6)))
+    print('Mana and spells are totals over {} turns, least valuable cards first'.format(num_turns))
+    print('{:<32} {:>6} {:>16} {:>7}  {}'.format('Card', 'Copies', 'Mana', 'Spells',
+                                               ''.join('{:>6}'.format('T' + str(turn + 1))
+                                                       for turn in range(num_turns))))
+    for mana, spells, name, p, per_turn in rows:
+        print('{:<32} {:>6} {:>16} {:>+7.2f}  {}'.format(
+              name[:32], counts[name], '{:+.2f} p={:.3f}{}'.format(mana, p, '*' if p < 1 - confidence else ' '),
+              spells, ''.join('{:>+6.2f}'.format(value) for value in per_turn)))
+
+
+# What-if analysis: a game is paused at the start of a turn, from a real
+# game (play_until) or a given opening hand (opening_position), and each
+# candidate decision is played out from many forks of it.
+
+# A game starting from the given opening hand, with no mulligans taken.
+def opening_position(library, commander, num_turns, hand, rng, strategy=DEFAULT_STRATEGY):
+    env = new_game(library, num_turns, rng, strategy=strategy)
+    remaining = list(library)
+    for name in hand:
+        card = next((card for card in remaining if card.name == name), None)
+        if card is None:
+            raise ValueError("The deck doesn't have {} {}".format(hand.count(name), name))
+        remaining.remove(card)
+        env['hand'].append(card)
+    env['library'] = Library(remaining, env['library'].rng)
+    env['library'].shuffle()
+    env['cards_drawn'] = [(card.name, env['turn']) for card in env['hand']]
+    if commander:
+        env['hand'].append(commander)
+    return env
+
+
+# Plays the game on to the start of turn, where it can be forked.
+def play_until(env, turn):
+    play_turns(env, env['turn'] - 1, turn - 1)
+    env['turn'] = turn
+
+
+# A copy of a paused game to play on with its own rng, and a library stream
+# seeded from it, so forks given the same rng draw the same cards whatever
+# they decide. Forks share the card
+# objects, and the battlefield until they change it, and only copy the
+# small per-game lists. The order of the library is forgotten, since the
+# player doesn't know it. The mana pool is emptied at the start of the next
+# turn anyway, so it's shared.
+def fork_game(env, rng):
+    fork = dict(env)
+    fork['rng'] = rng
+    fork['library'] = Library(env['library'], library_rng(rng))
+    fork['library'].shuffle()
+    fork['hand'] = list(env['hand'])
+    fork['played_cards'] = env['played_cards'].fork()
+    for key in ('cards_drawn', 'cards_played', 'turn_mana', 'turn_excess', 'turn_land_plays'):
+        fork[key] = list(env[key])
+    fork['delays'] = dict(env['delays'])
+    fork['extra_play_effects'] = {card: list(effects) for card, effects in env['extra_play_effects'].items()}
+    fork['trace'] = None
+    return fork
+
+
+# Decisions for what_if.
+def take_mulligan(env):
+    commander = [card for card in env['hand'] if card.is_commander]
+    env['hand'] = [card for card in env['hand'] if not card.is_commander]
+    mulligan_hands(env, len(env['hand']) - 1, force=True)
+    env['hand'] += commander
+
+
+def play_first(*names):
+    def fun(env):
+        env['strategy'] = PlayFirst(env['strategy'], names, env['turn'])
+    return fun
 
-            excess_mana[turn] += len(env['mana_pool']) / num_iterations
-            generated_mana[turn][iteration] = env['mana_generated']
-            max_mana = max(max_mana, env['mana_generated'])
 
-            to_remove = [card for card in env['hand'] if card.name == 'Draw Spell']
-            for card in to_remove:
-                env['hand'].remove(card)
-            hand_len = len(env['hand'])
-            if hand_len > 7:
-                for card in should_discard(env, hand_len - 7):
+# Plays the named cards first (if they can be played) on the given turn, and
+# otherwise plays like strategy.
+class PlayFirst(Strategy):
+    def __init__(self, strategy, names, turn):
+        super().__init__()
+        self.strategy = strategy
+        self.names = names
+        self.turn = turn
+
+    def should_mulligan(self, hand):
+        return self.strategy.should_mulligan(hand)
+
+    def mulligan_class(self, card):
+        return self.strategy.mulligan_class(card)
+
+    def should_play(self, env):
+        if env['turn'] == self.turn:
+            for name in self.names:
+                card = next((card for card in env['hand'] if card.name == name), None)
+                if card is not None:
+                    yield card
+        yield from self.strategy.should_play(env)
+
+    def should_discard(self, env, num):
+        return self.strategy.should_discard(env, num)
+
+
+# Plays iterations forks of the paused game in env for each decision, a
+# function that changes the fork before it goes on (None leaves it as it
+# is), and returns a DeckComparison of the decisions against the first one.
+# Fork i of every decision gets the same seed, so the differences are paired.
+def what_if(env, decisions, iterations, seed):
+    num_turns = len(env['turn_mana'])
+    comparison = DeckComparison(len(decisions), num_turns)
+    for iteration in range(iterations):
+        baseline_env = None
+        for index, decision in enumerate(decisions):
+            fork = fork_game(env, random.Random(game_seed(seed, iteration)))
+            if decision is not None:
+                decision(fork)
+            play_turns(fork, fork['turn'] - 1, num_turns)
+            comparison.stats[index].add_game(fork)
+            if baseline_env is None:
+                baseline_env = fork
+            else:
+                comparison.paired[index].add_pair(fork, baseline_env)
+    return comparison
+
+
+def find_decks(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.dck')
+    return sorted(glob.glob(pattern))
+
+
+def run_comparison(args, seed):
+    paths = find_decks(args.deck)
+    if args.baseline is not None:
+        baseline = os.path.abspath(args.baseline)
+        paths = [args.baseline] + [path for path in paths if os.path.abspath(path) != baseline]
+    if len(paths) < 2:
+        print("Need at least two deck files to compare, found {}".format(len(paths)))
+        return
+    if args.batch:
+        print("Comparisons need game by game results, using the object engine")
+    decks = tuple(read_deck_lines(path) for path in paths)
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    num_iterations = 500 if args.iterations is None else int(args.iterations)
+    comparison = DeckComparison(len(decks), args.num_turns)
+    with ChunkRunner(args.num_turns, seed, args.workers, exact_mulligans=args.exact_mulligans,
+                     sampling=args.sampling) as runner:
+        for chunk in runner.compare_ranges(decks, chunk_ranges(num_iterations, max(1, args.workers) * 4)):
+            comparison.merge(chunk)
+    comparison.report(names, args.confidence)
+
+
+def run_what_if(args, library, commander, seed):
+    num_iterations = 500 if args.iterations is None else int(args.iterations)
+    turn = 1 if args.at_turn is None else args.at_turn
+    if not 1 <= turn <= args.num_turns:
+        print("--at-turn has to be between 1 and {}".format(args.num_turns))
+        return
+    rng = random.Random(game_seed(seed, args.game))
+    if args.hand is not None:
+        try:
+            env = opening_position(library, commander, args.num_turns, args.hand, rng)
+        except ValueError as error:
+            print(error)
+            return
+    else:
+        env = start_game(library, commander, args.num_turns, rng)
+    play_until(env, turn)
+    if args.play is not None:
+        # Playing a card that isn't there would only play the game as usual again.
+        missing = [name for name in args.play if all(card.name != name for card in env['hand'])]
+        if len(missing) > 0:
+            print("{} isn't in the hand on turn {}: {}".format(
+                  ', '.join(missing), turn, ', '.join(sorted(card.name for card in env['hand']))))
+            return
+        names = ['As usual'] + ['Play {}'.format(name) for name in args.play]
+        decisions = [None] + [play_first(name) for name in args.play]
+    elif turn == 1:
+        names = ['Keep', 'Mulligan']
+        decisions = [None, take_mulligan]
+    else:
+        print("Give the cards to try playing first on turn {} with --play".format(turn))
+        return
+    print('Turn {}, {} mulligans, hand: {}'.format(turn, env['mulligans'],
+          ', '.join(sorted(card.name for card in env['hand']))))
+    print('In play: {}'.format(', '.join(sorted(card.name for card in env['played_cards'])) or 'nothing'))
+    print('{} cards left in the library, {} continuations of each choice'.format(len(env['library']),
+                                                                                num_iterations))
+    what_if(env, decisions, num_iterations, seed).report(names, args.confidence)
+
+
+def parse_objective(objective):
+    kind, turn = objective.split(':')
+    if kind not in ('mana', 'median', 'spells'):
+        raise ValueError("Unknown objective {}".format(kind))
+    return kind, int(turn)
+
+
+def objective_value(stats, objective):
+    kind, turn = objective
+    if kind == 'mana':
+        return stats.mean(turn - 1)
+    elif kind == 'median':
+        return stats.median(turn - 1)
+    return sum(stats.spells_sums[:turn]) / stats.num_games
+
+
+def describe_objective(objective):
+    kind, turn = objective
+    if kind == 'spells':
+        return 'spells cast by turn {}'.format(turn)
+    return '{} mana on turn {}'.format('mean' if kind == 'mana' else 'median', turn)
+
+
+def is_mana_card(card):
+    return (card.is_land or len(card.managen) > 0 or len(card.mana_effects) > 0 or
+            len(card.turn_effects) > 0 or len(card.play_effects) > 0)
+
+
+def split_deck(deck_lines):
+    counts = Counter()
+    extra_lines = []
+    for line in deck_lines:
+        if line.startswith('SB:'):
+            extra_lines.append(line)
+            continue
+        quantity, *parts = line.split()
+        counts[' '.join(parts)] += int(quantity)
+    return counts, tuple(extra_lines)
+
+
+def deck_to_lines(counts, extra_lines=()):
+    return tuple('{} {}\n'.format(quantity, name) for name, quantity in counts.items()
+                 if quantity > 0) + tuple(extra_lines)
+
+
+# Keeps stats for every deck it has seen, so re-evaluating a deck with more
+# games only simulates the extra ones. All decks use the same game seeds,
+# which makes comparisons between them far less noisy.
+class DeckEvaluator:
+    def __init__(self, runner, objective, chunk_size=100):
+        self.runner = runner
+        self.objective = objective
+        self.chunk_size = chunk_size
+        self.stats = {}
+
+    def evaluate(self, decks, games):
+        tasks = []
+        for deck in decks:
+            stats = self.stats.setdefault(deck, SimulationStats(self.runner.num_turns))
+            for start in range(stats.num_games, games, self.chunk_size):
+                tasks.append((deck, start, min(start + self.chunk_size, games)))
+        for (deck, start, stop), chunk in zip(tasks, self.runner.run(tasks)):
+            self.stats[deck].merge(chunk)
+        return [objective_value(self.stats[deck], self.objective) for deck in decks]
+
+
+# Local search over single-card swaps. Each round samples some swaps and
+# narrows them down with successive halving, doubling the games each time
+# the field is halved, then keeps the winner if it beats the current deck.
+# Only cards in the pool are swapped in or out, the rest of the deck is
+# left alone.
+def optimize_deck(deck_lines, pool, objective, seed, workers=1, rounds=20, candidates=16,
+                  games=100, min_copies=None, batch=False, exact_mulligans=False):
+    min_copies = min_copies or {}
+    rng = random.Random(seed)
+    counts, extra_lines = split_deck(deck_lines)
+    current = deck_to_lines(counts, extra_lines)
+    description = describe_objective(objective)
+    with ChunkRunner(objective[1], seed, workers, batch, exact_mulligans) as runner:
+        evaluator = DeckEvaluator(runner, objective)
+        for round_number in range(1, rounds + 1):
+            removable = [name for name in counts
+                         if name in pool and counts[name] > min_copies.get(name, 0)]
+            addable = [name for name in pool if counts[name] < pool[name]]
+            swaps = {(remove, add) for remove in removable for add in addable if remove != add}
+            if len(swaps) == 0:
+                if len(removable) == 0:
+                    print('Round {}: no candidate moves, no card of the pool can be taken out'.format(
+                          round_number))
+                else:
+                    print('Round {}: no candidate moves, no card of the pool can be added'.format(round_number))
+                break
+            swaps = rng.sample(sorted(swaps), min(candidates, len(swaps)))
+            variants = {}
+            for remove, add in swaps:
+                variant = counts.copy()
+                variant[remove] -= 1
+                variant[add] += 1
+                variants[(remove, add)] = deck_to_lines(variant, extra_lines)
+            num_games = games
+            while True:
+                values = evaluator.evaluate([variants[swap] for swap in swaps], num_games)
+                ranked = sorted(zip(values, range(len(swaps))), key=lambda x: -x[0])
+                swaps = [swaps[i] for value, i in ranked]
+                if len(swaps) == 1:
+                    break
+                swaps = swaps[:(len(swaps) + 1) // 2]
+                num_games *= 2
+            remove, add = swaps[0]
+            before, after = evaluator.evaluate([current, variants[(remove, add)]], num_games)
+            if after > before:
+                counts[remove] -= 1
+                counts[add] += 1
+                if counts[remove] == 0:
+                    del counts[remove]
+                current = variants[(remove, add)]
+                print('Round {}: -1 {} +1 {}, {:.3f} -> {:.3f} {} ({} games)'.format(
+                      round_number, remove, add, before, after, description, num_games))
+            else:
+                print('Round {}: best swap -1 {} +1 {} gave {:.3f} against {:.3f}, keeping the deck'.format(
+                      round_number, remove, add, after, before))
+        value, = evaluator.evaluate([current], games)
+    return current, value
+
+
+def optimizer_pool(args, counts, commander):
+    max_copies = args.max_copies
+    if max_copies is None:
+        max_copies = 1 if commander is not None else 4
+    if args.pool is not None:
+        pool, extra_lines = split_deck(read_deck_lines(args.pool))
+    else:
+        pool = Counter({name: max_copies for name, card in cards.items() if is_mana_card(card)})
+    for name in pool:
+        if name in BASIC_LANDS:
+            pool[name] = sum(counts.values())
+    return pool
+
+
+def run_optimizer(args, deck_lines, commander, seed):
+    objective = parse_objective(args.optimize)
+    counts, extra_lines = split_deck(deck_lines)
+    pool = optimizer_pool(args, counts, commander)
+    min_copies = {name: 1 for name in args.must_include}
+    missing = [name for name in min_copies if counts[name] == 0]
+    if len(missing) > 0:
+        print("--must-include cards have to be in the deck already: {}".format(', '.join(missing)))
+        return
+    best, value = optimize_deck(deck_lines, pool, objective, seed, args.workers, args.rounds,
+                                args.candidates, args.games, min_copies, args.batch, args.exact_mulligans)
+    print('\nBest deck found, {:.3f} {}:'.format(value, describe_objective(objective)))
+    print(''.join(best), end='')
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            output.writelines(best)
+
+
+PROFILED_PHASES = ['mulligan_phase', 'upkeep_phase', 'draw_phase', 'mana_phase', 'main_phase',
+                   'discard_phase', 'cleanup_phase', 'simulate_batch']
+PROFILED_FUNCTIONS = ['should_mulligan', 'should_play', 'should_discard', 'draw_cards',
+                      'can_pay', 'pay_cost', 'order_mana', 'mana_signature']
+PROFILED_METHODS = [(Card, 'can_play'), (FillerCard, 'can_play'), (Card, 'play'),
+                    (Card, 'generate_mana'), (ManaPool, 'can_pay'), (ManaPool, 'pay'),
+                    (SimulationStats, 'add_game'), (SimulationStats, 'report')]
+
+
+def effect_label(effect):
+    return getattr(effect, '__qualname__', repr(effect)).replace('.<locals>', '')
+
+
+# Counts calls and time spent in the turn phases, the strategy and mana
+# functions and every card effect. Nothing is instrumented until enable() is
+# called, which replaces the module functions, methods and registry effect
+# lists with timed wrappers, so normal runs pay nothing for it. Times are
+# inclusive, e.g. main_phase contains should_play.
+class Profiler:
+    def __init__(self):
+        self.calls = Counter()
+        self.times = Counter()
+        self.sections = {}
+        self.patched = []
+        self.start = None
+        self.elapsed = 0
+
+    def wrap(self, section, name, fun):
+        calls = self.calls
+        times = self.times
+        clock = time.perf_counter
+        self.sections[name] = section
+
+        # Generators are timed over every step, not just their creation.
+        if inspect.isgeneratorfunction(fun):
+            @functools.wraps(fun)
+            def profiled_generator(*args, **kwargs):
+                calls[name] += 1
+                generator = fun(*args, **kwargs)
+                while True:
+                    start = clock()
                     try:
-                        env['hand'].remove(card)
-                    except ValueError:
-                        print("Couldn't find card to discard")
-            if env['example'] and len(to_remove) > 0:
-                print('Discarding: ', ', '.join(['{}'] * len(to_remove)).format(*sorted(to_remove,
-                                                                                        key=lambda x: x.name)))
-
-            dead_cards = []
-            for card in env['played_cards']:
-                if not card.survives_turn(env):
-                    dead_cards.append(card)
-            for card in dead_cards:
-                env['played_cards'].remove(card)
-                if card.is_commander:
-                    card.cost += [1, 1]
-                    env['hand'].append(card)
-
-        cards_drawn += env['cards_drawn']
-        cards_played += env['cards_played']
-
-    mana_at_turn = [0] * num_turns
-    for i, mana in enumerate(generated_mana):
-        mana_at_turn[i] = statistics.median(mana)
-
-    card_stats = defaultdict(lambda: [0, 0, 0, 0, 0, 0])
-    spells_cast = [0] * num_turns
-    total_spells_cast = 0
-    for card, turn in cards_drawn:
-        card_stats[card][0] += turn
-        card_stats[card][2] += 1
-        card_obj = cards.get(card, FillerCard(name='Filler'))
-        if mana_at_turn[turn - 1] <= len(card_obj.cost):
-            card_stats[card][4] += 1
-    for card, turn in cards_played:
-        card_stats[card][1] += turn
-        card_stats[card][3] += 1
-        card_obj = cards.get(card, FillerCard(name='Filler'))
-        if mana_at_turn[turn - 1] <= len(card_obj.cost):
-            card_stats[card][5] += 1
-        if not card_obj.is_land and card != "Draw Spell":
-            spells_cast[turn - 1] += 1
-            total_spells_cast += 1
-
-    for i, mana in enumerate(generated_mana):
-        print('Turn {:2.0f}: {:3.0f} median, {:3.2f} mean, and {:3.2f} stddev with {:3.2f} mean excess, and {:2.2f} spells cast'.format(i + 1, # noqa
-              mana_at_turn[i], statistics.mean(mana), statistics.pstdev(mana), excess_mana[i],
-              spells_cast[i] / num_iterations))
-    print('Max: {:.2f}'.format(max_mana))
-    print('Average spells cast: {:2.2f}'.format(total_spells_cast / num_iterations))
-    print('\n{:.2f} mean cards drawn'.format(len(cards_drawn) / num_iterations))
-    print('{:.2f} mulligans per game\n'.format(average_mulligans))
-    if not example:
-        for card, val in sorted(card_stats.items(), key=lambda x: x[1][5] / max(x[1][4], 1)):
-            play_to_draw = float("inf") if val[2] == 0 else val[3] / val[2] * 100
-            percent_played = min(100, 100 * val[3] / num_iterations)
-            percent_drawn = min(100, 100 * val[2] / num_iterations)
-            draw_on_curve = val[4] / num_iterations
-            play_on_curve = val[5] / num_iterations
-            on_curve_ratio = float("inf") if draw_on_curve == 0 else play_on_curve / draw_on_curve
-            print('{} {} was drawn {:3.0f}% and played {:3.0f}% of games with play/draw ratio {:3.0f}%. Drawn {:3.0f}% and played {:3.0f}% with ratio {:3.0f}% on curve'.format(card, # noqa
-                    ' ' * (30 - len(card)), percent_drawn, percent_played, play_to_draw,
-                    draw_on_curve * 100, play_on_curve * 100, on_curve_ratio * 100))
+                        value = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        times[name] += clock() - start
+                    yield value
+            return profiled_generator
+
+        @functools.wraps(fun)
+        def profiled(*args, **kwargs):
+            start = clock()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                times[name] += clock() - start
+                calls[name] += 1
+        return profiled
+
+    def wrap_effect_spells(self, new_effect_spell):
+        def profiled_new_effect_spell(name, cost, play_effects, priority_keys):
+            play_effects = [self.wrap('card', '{} play: {}'.format(name, effect_label(effect)), effect)
+                            for effect in play_effects]
+            return new_effect_spell(name, cost, play_effects, priority_keys)
+        return profiled_new_effect_spell
+
+    # Extra play effects are counted together whichever card they were given
+    # to, there can be one for every card of the deck.
+    def wrap_extra_play_effects(self, add_extra_play_effect):
+        def profiled_add_extra_play_effect(env, card, effect):
+            add_extra_play_effect(env, card, self.wrap('card', 'Extra play: {}'.format(effect_label(effect)),
+                                                       effect))
+        return profiled_add_extra_play_effect
+
+    def patch(self, owner, attribute, wrapped):
+        self.patched.append((owner, attribute, getattr(owner, attribute)))
+        setattr(owner, attribute, wrapped)
+
+    def enable(self):
+        module = sys.modules[__name__]
+        for name in PROFILED_PHASES:
+            self.patch(module, name, self.wrap('phase', name, getattr(module, name)))
+        for name in PROFILED_FUNCTIONS:
+            self.patch(module, name, self.wrap('function', name, getattr(module, name)))
+        for owner, name in PROFILED_METHODS:
+            label = '{}.{}'.format(owner.__name__, name)
+            self.patch(owner, name, self.wrap('function', label, owner.__dict__[name]))
+        # Decks are copied from the registry, so wrapping its effect lists
+        # covers every card parsed afterwards.
+        for card_name, card in cards.items():
+            for attribute, kind in (('play_effects', 'play'), ('turn_effects', 'turn'),
+                                    ('mana_effects', 'mana')):
+                effects = getattr(card, attribute)
+                if len(effects) == 0:
+                    continue
+                wrapped = [self.wrap('card', '{} {}: {}'.format(card_name, kind, effect_label(effect)),
+                                     effect)
+                           for effect in effects]
+                self.patch(card, attribute, wrapped)
+        # Effects made as games run are wrapped when they're made.
+        self.patch(module, 'new_effect_spell', self.wrap_effect_spells(module.new_effect_spell))
+        self.patch(module, 'add_extra_play_effect', self.wrap_extra_play_effects(module.add_extra_play_effect))
+        cached_deck.cache_clear()
+        self.start = time.perf_counter()
+
+    def disable(self):
+        self.elapsed = time.perf_counter() - self.start
+        for owner, attribute, original in reversed(self.patched):
+            setattr(owner, attribute, original)
+        self.patched = []
+        cached_deck.cache_clear()
+
+    def report(self, out=None):
+        out = out or sys.stdout
+        print('\nProfile ({:.3f}s total, times include nested calls)'.format(self.elapsed), file=out)
+        for section, title in (('phase', 'Phases'), ('function', 'Functions'), ('card', 'Card effects')):
+            names = [name for name in self.calls if self.sections[name] == section]
+            if len(names) == 0:
+                continue
+            print('\n{:<56} {:>10} {:>10} {:>10} {:>6}'.format(title, 'calls', 'seconds', 'us/call', '%'),
+                  file=out)
+            for name in sorted(names, key=lambda n: -self.times[n]):
+                print('{:<56} {:>10} {:>10.3f} {:>10.2f} {:>6.1f}'.format(
+                      name[:56], self.calls[name], self.times[name],
+                      1e6 * self.times[name] / self.calls[name],
+                      100 * self.times[name] / self.elapsed if self.elapsed > 0 else 0), file=out)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('deck', nargs='?')
+    parser.add_argument('iterations', nargs='?')
+    parser.add_argument('num_turns', nargs='?', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to split the iterations across')
+    parser.add_argument('--seed', type=int,
+                        help='seed for a reproducible run, independent of --workers')
+    parser.add_argument('--precision', type=float,
+                        help='run batches until the mean mana and spells cast of every turn and the'
+                             ' mulligans per game are known to within this')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='confidence level used for --precision and the reported intervals')
+    parser.add_argument('--time-budget', type=float,
+                        help='stop running batches after this many seconds')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='games per batch between convergence checks')
+    parser.add_argument('--batch', action='store_true',
+                        help='use the vectorized NumPy engine for decks of cards without effects')
+    parser.add_argument('--optimize', metavar='OBJECTIVE',
+                        help='search card swaps to maximise mana:TURN, median:TURN or spells:TURN')
+    parser.add_argument('--pool',
+                        help='deck file of cards the optimizer may use, quantities are the max copies')
+    parser.add_argument('--must-include', action='append', default=[], metavar='CARD',
+                        help='card the optimizer has to keep at least one copy of')
+    parser.add_argument('--max-copies', type=int,
+                        help='max copies of non-basic pool cards, 1 for commander decks and 4 otherwise')
+    parser.add_argument('--rounds', type=int, default=20, help='optimizer rounds')
+    parser.add_argument('--candidates', type=int, default=16, help='swaps sampled per optimizer round')
+    parser.add_argument('--games', type=int, default=100,
+                        help='games per swap in the first successive halving step')
+    parser.add_argument('--output', help='file to write the optimized deck to')
+    parser.add_argument('--compare', action='store_true',
+                        help='treat deck as a directory or glob of deck files and compare them side by side')
+    parser.add_argument('--baseline',
+                        help='deck file the others are compared against, by default the first one found')
+    parser.add_argument('--records', metavar='FILE',
+                        help='write every game\'s per-turn results to FILE in a binary columnar format')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='record every game\'s draws, plays, mana, discards and deaths to FILE')
+    parser.add_argument('--trace-games', metavar='GAMES',
+                        help='only trace these games, e.g. 0-99,1234')
+    parser.add_argument('--replay', metavar='TRACE',
+                        help='replay a game of a --trace file from its seed and print what happens')
+    parser.add_argument('--game', type=int, default=0,
+                        help='game to replay, or to show in example mode')
+    parser.add_argument('--hand', nargs='+', metavar='CARD',
+                        help='opening hand to start from, compares keeping it with a mulligan')
+    parser.add_argument('--at-turn', type=int, metavar='TURN',
+                        help='play game --game (or the --hand game) up to TURN and try --play choices')
+    parser.add_argument('--play', action='append', metavar='CARD',
+                        help='compare playing CARD first on --at-turn with playing as usual, repeatable')
+    parser.add_argument('--marginal', action='store_true',
+                        help='rank the cards by the mana and spells lost when one copy becomes Filler')
+    parser.add_argument('--exact-mulligans', action='store_true',
+                        help='print the exact mulligan odds and deal opening hands from them')
+    parser.add_argument('--sampling', choices=SAMPLING_SCHEMES, default='independent',
+                        help='how opening libraries are shuffled: independently, in mirrored pairs'
+                             ' (antithetic) or spread over strata of mana producers in the opening hand'
+                             ' (stratified)')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='directory to keep the results of seeded runs in, to reuse or extend them')
+    parser.add_argument('--cache-size', type=float, default=256,
+                        help='megabytes the cache directory may use before old results are removed')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='periodically save the results so far to FILE, to --resume after a crash')
+    parser.add_argument('--checkpoint-every', type=float, default=60, metavar='SECONDS',
+                        help='seconds between checkpoints')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the run saved in the --checkpoint file')
+    parser.add_argument('--serve', metavar='[HOST]:PORT',
+                        help='hand the games out in chunks to --connect workers listening on this address')
+    parser.add_argument('--connect', metavar='HOST:PORT',
+                        help='play chunks for the --serve coordinator at this address, --workers at once')
+    parser.add_argument('--chunk-timeout', type=float, default=300, metavar='SECONDS',
+                        help='seconds before a chunk that hasn\'t come back is handed to another worker')
+    parser.add_argument('--worker-timeout', type=float, default=300, metavar='SECONDS',
+                        help='seconds --serve waits with no worker connected before giving up')
+    parser.add_argument('--profile', action='store_true',
+                        help='time each phase, strategy function and card effect and print a breakdown')
+    args = parser.parse_args(argv[1:])
+    # Each of these picks how the games are run, run_command only follows one.
+    modes = [flags for flags, used in (
+        ('--compare', args.compare),
+        ('--optimize', args.optimize is not None),
+        ('--hand/--at-turn/--play', args.hand is not None or args.at_turn is not None or args.play is not None),
+        ('--marginal', args.marginal),
+        ('--precision/--time-budget', args.precision is not None or args.time_budget is not None),
+        ('--records/--trace', args.records is not None or args.trace is not None),
+        ('--serve', args.serve is not None),
+        ('--checkpoint', args.checkpoint is not None),
+        ('--cache', args.cache is not None),
+        ('--replay', args.replay is not None),
+        ('--connect', args.connect is not None)) if used]
+    if len(modes) > 1:
+        parser.error('{} can\'t be combined'.format(' and '.join(modes)))
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume needs --checkpoint')
+    if args.trace_games is not None and args.trace is None:
+        parser.error('--trace-games needs --trace')
+    return args
+
+
+def main(argv=None):
+    if not argv:
+        argv = sys.argv
+    args = parse_args(argv)
+    if args.replay is not None:
+        replay_game(args.replay, args.game)
+        return
+    if args.connect is not None:
+        run_workers(parse_address(args.connect), args.workers)
+        return
+    if args.deck is None:
+        print("Need to supply a deck file")
+        return
+    example = args.iterations == 'example'
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    if args.profile:
+        if args.workers > 1:
+            print("Profiling runs in a single process, ignoring --workers")
+            args.workers = 1
+        profiler = Profiler()
+        profiler.enable()
+        try:
+            run_command(args, example, seed)
+        finally:
+            profiler.disable()
+        profiler.report()
+        return
+    run_command(args, example, seed)
+
+
+def run_command(args, example, seed):
+    if args.compare:
+        run_comparison(args, seed)
+        return
+    deck_lines = read_deck_lines(args.deck)
+    library, commander = parse_deck(deck_lines, verbose=True)
+    print(len(library))
+    if args.sampling != 'independent' and args.exact_mulligans:
+        print("Opening hands come from the exact mulligan odds, ignoring --sampling")
+        args.sampling = 'independent'
+    if args.sampling != 'independent' and args.batch:
+        print("The batch engine only samples games independently, using the object engine")
+        args.batch = False
+    if args.batch and not numpy_available():
+        print("NumPy isn't installed, using the object engine")
+    elif args.batch and len(batch_unsupported(library, commander)) > 0:
+        print("Using the object engine, the batch engine can't simulate: {}".format(
+              ', '.join(batch_unsupported(library, commander))))
+    if args.exact_mulligans:
+        opening_table(library).report()
+        print()
+    if args.optimize is not None:
+        run_optimizer(args, deck_lines, commander, seed)
+        return
+    if args.hand is not None or args.at_turn is not None or args.play is not None:
+        run_what_if(args, library, commander, seed)
+        return
+    if args.marginal:
+        if args.batch:
+            print("Marginal values need game by game results, using the object engine")
+        num_iterations = 500 if args.iterations is None or example else int(args.iterations)
+        names, comparison = marginal_values(deck_lines, num_iterations, args.num_turns, seed, args.workers,
+                                            args.exact_mulligans, args.sampling)
+        report_marginal_values(deck_lines, names, comparison, args.confidence)
+        return
+    if not example and (args.precision is not None or args.time_budget is not None):
+        max_iterations = None if args.iterations is None else int(args.iterations)
+        stats, reason = run_until_converged(deck_lines, args.num_turns, seed,
+                                            args.precision, args.confidence, args.time_budget,
+                                            max_iterations, args.batch_size, args.workers, args.batch,
+                                            args.exact_mulligans, args.sampling)
+        print('Stopped after {} games, {}'.format(stats.num_games, reason))
+        stats.report(confidence=args.confidence)
+        return
+    start = 0
+    if example:
+        start = args.game
+        num_iterations = start + 1
+    else:
+        num_iterations = 500 if args.iterations is None else int(args.iterations)
+    if (args.records is not None or args.trace is not None) and not example:
+        if args.batch:
+            print("Records and traces need game by game results, using the object engine")
+        if args.sampling != 'independent':
+            print("Records and traces replay games from their seeds, ignoring --sampling")
+        trace_games = None if args.trace_games is None else parse_game_ranges(args.trace_games)
+        stats = record_simulation(deck_lines, num_iterations, args.num_turns, seed, args.workers,
+                                  args.exact_mulligans, args.records, args.trace, trace_games)
+    elif args.serve is not None and not example:
+        if args.batch:
+            print("Distributed runs use the object engine so every chunk matches a local run")
+        stats = distributed_simulation(parse_address(args.serve), deck_lines, num_iterations, args.num_turns,
+                                       seed, args.exact_mulligans, args.sampling, args.chunk_timeout,
+                                       idle_timeout=args.worker_timeout)
+        if stats is None:
+            return
+    elif args.checkpoint is not None and not example:
+        if args.resume and args.seed is None:
+            checkpoint = read_checkpoint(args.checkpoint)
+            if checkpoint is not None:
+                seed = checkpoint['seed']
+        stats = checkpointed_simulation(args.checkpoint, deck_lines, library, commander, num_iterations,
+                                        args.num_turns, seed, args.workers, args.batch,
+                                        args.exact_mulligans, args.resume, args.checkpoint_every,
+                                        args.sampling)
+        if stats is None:
+            return
+    elif args.cache is not None and args.seed is not None and not example:
+        cache = ResultCache(args.cache, int(args.cache_size * 2 ** 20))
+        stats = cached_simulation(cache, deck_lines, library, commander, num_iterations, args.num_turns,
+                                  seed, args.workers, args.batch, args.exact_mulligans, args.sampling)
+    else:
+        if args.cache is not None and args.seed is None:
+            print("Results are only cached for runs with --seed")
+        stats = run_simulation(deck_lines, library, commander, num_iterations, args.num_turns, seed,
+                               args.workers, example, args.batch, start, args.exact_mulligans,
+                               args.sampling)
+    stats.report(example)
 
 
 if __name__ == "__main__":
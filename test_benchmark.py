@@ -0,0 +1,22 @@
+import json
+
+import benchmark
+
+
+def test_benchmark_runs_from_anywhere_and_compares(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    results_path = str(tmp_path / 'results.json')
+    args = ['benchmark.py', '--scale', '0.02', '--repeat', '1', '--no-memory']
+    assert benchmark.main(args + ['-o', results_path]) == 0
+    with open(results_path) as results_file:
+        results = json.load(results_file)
+    assert set(results['workloads']) == set(benchmark.WORKLOADS)
+    for name, result in results['workloads'].items():
+        deck, games, turns = benchmark.WORKLOADS[name]
+        assert result['games'] == max(1, int(games * 0.02)) and result['turns'] == turns
+        assert result['games_per_sec'] > 0
+        assert len(result['stats']['mean_mana']) == turns
+        assert set(result['turn_phases']) <= set(benchmark.mtgsim.PROFILED_PHASES)
+    # The same seeds give the same statistics, and speed isn't checked here.
+    assert benchmark.main(args + ['--no-turn-phases', '--compare', results_path, '--slowdown', '1']) == 0
+    assert 'REGRESSION' not in capsys.readouterr().out
@@ -0,0 +1,516 @@
+import collections
+import concurrent.futures
+import gc
+import io
+import itertools
+import json
+import mmap
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import weakref
+
+import mtgsim
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def deck(name):
+    return mtgsim.read_deck_lines(os.path.join(HERE, name))
+
+
+def report(stats):
+    out = io.StringIO()
+    stats.report(out=out)
+    return out.getvalue()
+
+
+# sealed.dck with its Servo Schematic, a spell without effects, swapped for
+# Filler.
+def servo_swapped():
+    return tuple('1 Filler\n' if line.strip() == '1 Servo Schematic' else line for line in deck('sealed.dck'))
+
+
+def test_identical_decks_pair_exactly():
+    lines = deck('sealed.dck')
+    comparison = mtgsim.compare_chunk(((lines, lines), 10, 1, 0, 200, False, 'independent'))
+    paired = comparison.paired[1]
+    assert paired.num_games == 200
+    assert paired.mana_sums == [0] * 10 and paired.mana_squares == [0] * 10
+    assert paired.spells_sums == [0] * 10 and paired.spells_squares == [0] * 10
+
+
+def test_swap_without_effects_keeps_the_mana():
+    lines = deck('sealed.dck')
+    comparison = mtgsim.compare_chunk(((lines, servo_swapped()), 10, 1, 0, 200, False, 'independent'))
+    paired = comparison.paired[1]
+    assert paired.mana_sums == [0] * 10 and paired.mana_squares == [0] * 10
+    assert paired.mana_difference(9) == (0, 1.0)
+
+
+def test_cards_without_effects_have_no_marginal_mana():
+    lines = deck('sealed.dck')
+    names, comparison = mtgsim.marginal_values(lines, 200, 10, 1)
+    library, commander = mtgsim.cached_deck(lines)
+    plain = {card.name for card in library
+             if not card.is_land and len(card.managen) == 0 and len(card.mana_effects) == 0 and
+             len(card.turn_effects) == 0 and len(card.play_effects) == 0}
+    assert 'Servo Schematic' in plain
+    for name, paired in zip(names, comparison.paired[1:]):
+        if name in plain:
+            assert paired.mana_sums == [0] * 10, name
+            assert paired.total_mana_difference() == (0, 1.0), name
+
+
+def free_port():
+    with socket.create_server(('127.0.0.1', 0)) as server:
+        return server.getsockname()[1]
+
+
+def bogus_worker(address):
+    while True:
+        try:
+            connection = socket.create_connection(address)
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    with connection, connection.makefile('rwb') as stream:
+        mtgsim.receive_message(stream)
+        mtgsim.send_message(stream, {'bogus': 1})
+
+
+def test_distributed_run_matches_one_process_and_survives_bad_replies():
+    lines = deck('gisela.dck')
+    library, commander = mtgsim.cached_deck(lines)
+    expected = mtgsim.simulate_range(library, commander, 6, 3, 0, 250)
+    address = ('127.0.0.1', free_port())
+    bogus = threading.Thread(target=bogus_worker, args=(address,))
+    bogus.start()
+    bogus.join(0.2)
+    worker = threading.Thread(target=mtgsim.run_worker, args=(address, 0.05))
+    worker.start()
+    stats = mtgsim.distributed_simulation(address, lines, 250, 6, 3, chunk_size=100, idle_timeout=30)
+    worker.join()
+    bogus.join()
+    assert report(stats) == report(expected)
+
+
+def test_distributed_run_without_workers_gives_up():
+    assert mtgsim.distributed_simulation(('127.0.0.1', free_port()), deck('gisela.dck'), 10, 3, 1,
+                                         idle_timeout=0.5) is None
+
+
+# The hand filtered and sorted for every rule on each pick, as should_play
+# did before PlayTracker.
+def scan_pick(env, table):
+    rng = env['rng']
+    playable = [card for card in env['hand'] if card.can_play(env)]
+    for index, rule in enumerate(table.rules):
+        when, test = table.whens[index], table.tests[index]
+        if when is not None and not when(env):
+            continue
+        choices = []
+        for position, card in enumerate(playable):
+            keys = dict(table.compile(card, env))
+            if index in keys and (test is None or test(card, env)):
+                choices.append((keys[index], position, card))
+        if len(choices) > 0:
+            if table.random[index]:
+                return min((card for key, position, card in choices), key=lambda c: rng.random())
+            return min(choices, key=lambda choice: choice[:2])[2]
+    if len(playable) > 0:
+        return rng.choice(playable)
+    return None
+
+
+class ScanStrategy(mtgsim.Strategy):
+    def should_play(self, env):
+        while True:
+            card = scan_pick(env, mtgsim.play_table)
+            if card is None:
+                return
+            yield card
+
+
+def test_play_tracker_picks_like_a_full_scan():
+    for name in ('gisela.dck', 'sealed.dck', 'testing.dck'):
+        library, commander = mtgsim.cached_deck(deck(name))
+        tracked = mtgsim.simulate_range(library, commander, 10, 5, 0, 150)
+        scanned = mtgsim.simulate_range(library, commander, 10, 5, 0, 150, strategy=ScanStrategy())
+        assert report(tracked) == report(scanned), name
+
+
+def test_lazy_library_shuffles_uniformly():
+    rng = random.Random(1)
+    orders = collections.Counter()
+    for i in range(24000):
+        library = mtgsim.Library('abcd', rng)
+        library.shuffle()
+        # Look before drawing, so settle() is reached in pieces.
+        top = library[0]
+        drawn = library.draw(1) + [library[1]] + library.draw(3)
+        assert drawn[0] == top and drawn[1] == drawn[3]
+        orders[''.join(drawn[:1] + drawn[2:])] += 1
+    assert len(orders) == 24
+    # Each order has 1000 expected, 4 standard deviations is about 125.
+    assert all(abs(count - 1000) < 125 for count in orders.values())
+
+
+def test_library_search_picks_copies_uniformly():
+    rng = random.Random(2)
+    library, commander = mtgsim.cached_deck(deck('gisela.dck'))
+    plains = [card for card in library if card.name == 'Plains']
+    picked = collections.Counter()
+    for i in range(2000):
+        picked[mtgsim.Library(library, rng).search(['Plains'])] += 1
+    assert set(picked) == set(plains)
+    expected = 2000 / len(plains)
+    assert all(abs(count - expected) < 4 * expected ** 0.5 for count in picked.values())
+
+
+def test_mulligan_table_matches_the_mulligan_loop():
+    library, commander = mtgsim.cached_deck(deck('gisela.dck'))
+    table = mtgsim.MulliganTable(library)
+    distribution = table.mulligan_distribution()
+    assert abs(sum(distribution.values()) - 1) < 1e-9
+    games = 20000
+    counts = collections.Counter()
+    for i in range(games):
+        env = mtgsim.new_game(library, 1, random.Random(i))
+        mtgsim.mulligan_phase(env)
+        counts[env['mulligans']] += 1
+    for mulligans, p in distribution.items():
+        assert abs(counts[mulligans] / games - p) < 4 * (p * (1 - p) / games) ** 0.5 + 1e-3, mulligans
+
+
+def test_stats_merge_and_state_round_trip():
+    library, commander = mtgsim.cached_deck(deck('sealed.dck'))
+    for sampling in mtgsim.SAMPLING_SCHEMES:
+        whole = mtgsim.simulate_range(library, commander, 8, 3, 0, 301, sampling=sampling)
+        merged = mtgsim.simulate_range(library, commander, 8, 3, 0, 101, sampling=sampling)
+        merged.merge(mtgsim.simulate_range(library, commander, 8, 3, 101, 301, sampling=sampling))
+        assert report(merged) == report(whole), sampling
+        state = json.loads(json.dumps(whole.state()))
+        restored = mtgsim.SimulationStats.from_state(state)
+        assert report(restored) == report(whole), sampling
+        assert json.loads(json.dumps(restored.state())) == state, sampling
+
+
+def test_sampling_reduces_the_variance_of_the_estimates():
+    lines = ('16 Mountain\n', '8 Plains\n', '3 Sol Ring\n', '2 Mind Stone\n', '1 Coldsteel Heart\n',
+             '30 Filler\n')
+    library, commander = mtgsim.cached_deck(lines)
+    # Spread of the estimates over 200 runs of 20 games each
+    variances = {}
+    for sampling in mtgsim.SAMPLING_SCHEMES:
+        runs = [mtgsim.simulate_range(library, commander, 6, seed, 0, 20, sampling=sampling)
+                for seed in range(200)]
+        variances[sampling] = (statistics.variance(run.mean(5) for run in runs),
+                               statistics.variance(run.mulligans / run.num_games for run in runs))
+    independent = variances['independent']
+    # Mirrored libraries matter most once many cards are drawn, the opening
+    # hand's producers for mulligans.
+    assert variances['antithetic'][0] < 0.8 * independent[0]
+    assert variances['stratified'][1] < 0.5 * independent[1]
+
+
+def test_workers_give_the_same_report():
+    lines = deck('gisela.dck')
+    library, commander = mtgsim.cached_deck(lines)
+    one = mtgsim.run_simulation(lines, library, commander, 300, 6, 4)
+    three = mtgsim.run_simulation(lines, library, commander, 300, 6, 4, workers=3)
+    assert report(one) == report(three)
+
+
+def test_batch_engine_matches_the_object_engine():
+    if not mtgsim.numpy_available():
+        return
+    lines = ('16 Mountain\n', '8 Plains\n', '3 Sol Ring\n', '2 Mind Stone\n', '1 Coldsteel Heart\n',
+             '30 Filler\n')
+    library, commander = mtgsim.cached_deck(lines)
+    assert mtgsim.batch_unsupported(library, commander) == []
+    batch = mtgsim.simulate_batch(library, commander, 8, 1, 0, 3000)
+    games = mtgsim.simulate_range(library, commander, 8, 1, 0, 3000)
+    assert batch.num_games == games.num_games == 3000
+
+    # Different shuffles, so the engines agree within the standard errors.
+    def agree(measure, interval):
+        error = (interval(batch) ** 2 + interval(games) ** 2) ** 0.5
+        return abs(measure(batch) - measure(games)) <= 5 * error
+    for turn in range(8):
+        assert agree(lambda stats: stats.mean(turn), lambda stats: stats.mean_interval(turn, 1)), turn
+        assert agree(lambda stats: stats.spells_sums[turn] / stats.num_games,
+                     lambda stats: stats.spells_interval(turn, 1)), turn
+    assert agree(lambda stats: stats.mulligans / stats.num_games, lambda stats: stats.mulligan_interval(1))
+
+
+def test_batch_falls_back_for_unsupported_cards():
+    lines = deck('sealed.dck')
+    library, commander = mtgsim.cached_deck(lines)
+    assert mtgsim.batch_unsupported(library, commander) == ['Renegade Map', 'Resourceful Return']
+    batch = mtgsim.simulate_chunk((lines, 6, 2, 0, 200, True, False, 'independent'))
+    assert report(batch) == report(mtgsim.simulate_range(library, commander, 6, 2, 0, 200))
+
+
+def game_position(env):
+    played = env['played_cards']
+    return (list(env['hand']), list(env['library']), list(played), dict(played.by_name), dict(played.lands),
+            dict(played.mana_sources), list(env['turn_mana']), list(env['cards_drawn']),
+            list(env['cards_played']))
+
+
+def test_forks_leave_the_paused_game_alone():
+    library, commander = mtgsim.cached_deck(deck('gisela.dck'))
+    for seed in range(20):
+        env = mtgsim.start_game(library, commander, 8, random.Random(seed))
+        mtgsim.play_until(env, 4)
+        before = game_position(env)
+        assert len(before[2]) > 0
+        for index, decision in enumerate((None, mtgsim.take_mulligan, mtgsim.play_first('Sol Ring'))):
+            fork = mtgsim.fork_game(env, random.Random(index))
+            if decision is not None:
+                decision(fork)
+            mtgsim.play_turns(fork, fork['turn'] - 1, 8)
+            assert len(fork['played_cards']) > len(before[2])
+            assert game_position(env) == before, seed
+
+
+def test_identical_decisions_pair_exactly():
+    library, commander = mtgsim.cached_deck(deck('gisela.dck'))
+    env = mtgsim.opening_position(library, commander, 8, ['Mountain', 'Plains', 'Sol Ring', 'Filler', 'Filler',
+                                                          'Filler', 'Filler'], random.Random(1))
+    mtgsim.play_until(env, 2)
+    for decisions in ([None, None], [mtgsim.play_first('Filler'), mtgsim.play_first('Filler')]):
+        comparison = mtgsim.what_if(env, decisions, 100, 1)
+        paired = comparison.paired[1]
+        assert paired.num_games == 100
+        assert paired.mana_sums == [0] * 8 and paired.mana_squares == [0] * 8
+        assert paired.spells_sums == [0] * 8 and paired.spells_squares == [0] * 8
+
+
+def test_what_if_rejects_cards_not_in_the_hand(capsys):
+    mtgsim.main(['mtgsim.py', os.path.join(HERE, 'gisela.dck'), '50', '--seed', '1', '--play', 'Not A Card'])
+    out = capsys.readouterr().out
+    assert "Not A Card isn't in the hand on turn 1" in out
+    assert 'As usual' not in out
+
+
+def test_optimizer_keeps_to_the_pool_and_copy_limits(monkeypatch, capsys):
+    lines = deck('gisela.dck')
+    counts, extra_lines = mtgsim.split_deck(lines)
+    pool = collections.Counter({'Mana Crypt': 2, 'Sol Ring': 4, 'Mind Stone': 2, 'Worn Powerstone': 1,
+                                'Filler': 60})
+    min_copies = {'Mana Crypt': 1}
+    candidates = []
+    evaluate = mtgsim.DeckEvaluator.evaluate
+
+    def recording_evaluate(self, decks, games):
+        candidates.extend(decks)
+        return evaluate(self, decks, games)
+    monkeypatch.setattr(mtgsim.DeckEvaluator, 'evaluate', recording_evaluate)
+    best, value = mtgsim.optimize_deck(lines, pool, ('mana', 4), 1, rounds=4, candidates=6, games=40,
+                                       min_copies=min_copies)
+    assert 'Round 4' in capsys.readouterr().out
+    assert best in candidates and len(set(candidates)) > 4
+    for candidate in set(candidates):
+        candidate_counts, candidate_extra = mtgsim.split_deck(candidate)
+        assert candidate_extra == extra_lines
+        assert sum(candidate_counts.values()) == sum(counts.values())
+        for name in set(counts) | set(candidate_counts):
+            if name in pool:
+                assert candidate_counts[name] <= max(pool[name], counts[name]), name
+            else:
+                assert candidate_counts[name] == counts[name], name
+        assert candidate_counts['Mana Crypt'] >= 1
+
+
+def test_evaluator_only_plays_the_extra_games(monkeypatch, capsys):
+    simulated = []
+    run = mtgsim.ChunkRunner.run
+
+    def recording_run(self, tasks):
+        tasks = list(tasks)
+        simulated.extend(tasks)
+        return run(self, tasks)
+    monkeypatch.setattr(mtgsim.ChunkRunner, 'run', recording_run)
+    lines = deck('gisela.dck')
+    other = tuple({'3 Sol Ring\n': '2 Sol Ring\n', '48 Filler\n': '49 Filler\n'}.get(line, line) for line in lines)
+    with mtgsim.ChunkRunner(4, 1) as runner:
+        evaluator = mtgsim.DeckEvaluator(runner, ('mana', 4), chunk_size=50)
+        evaluator.evaluate([lines, other], 100)
+        del simulated[:]
+        evaluator.evaluate([lines, other], 250)
+        assert sorted((start, stop) for deck_lines, start, stop in simulated) == [(100, 150), (100, 150),
+                                                                                   (150, 200), (150, 200),
+                                                                                   (200, 250), (200, 250)]
+        fresh = mtgsim.DeckEvaluator(runner, ('mana', 4), chunk_size=50)
+        fresh.evaluate([lines], 250)
+        assert report(evaluator.stats[lines]) == report(fresh.stats[lines])
+    # Successive halving plays the survivors on, it never replays a game.
+    del simulated[:]
+    pool = collections.Counter({'Sol Ring': 4, 'Mind Stone': 2, 'Worn Powerstone': 2, 'Filler': 60})
+    mtgsim.optimize_deck(lines, pool, ('mana', 4), 2, rounds=2, candidates=8, games=40)
+    capsys.readouterr()
+    assert len(simulated) > 0
+    assert len(simulated) == len(set(simulated))
+    games = collections.defaultdict(list)
+    for deck_lines, start, stop in simulated:
+        games[deck_lines].append((start, stop))
+    for ranges in games.values():
+        ranges.sort()
+        assert ranges[0][0] == 0
+        assert all(stop == start for (_, stop), (start, _) in zip(ranges, ranges[1:]))
+
+
+def test_records_and_traces_match_the_games(tmp_path, capsys):
+    lines = deck('sealed.dck')
+    library, commander = mtgsim.cached_deck(lines)
+    records_path = str(tmp_path / 'games.rec')
+    trace_path = str(tmp_path / 'games.trace')
+    stats = mtgsim.record_simulation(lines, 40, 6, 8, records_path=records_path, trace_path=trace_path)
+    assert report(stats) == report(mtgsim.simulate_range(library, commander, 6, 8, 0, 40))
+    if mtgsim.numpy_available():
+        records = mtgsim.read_records(records_path)
+        assert records['mana'].shape == (40, 6)
+        assert [int(total) for total in records['mana'].sum(axis=0)] == stats.mana_sums
+        assert int(records['mulligans'].sum()) == stats.mulligans
+    for game in (0, 17, 39):
+        mtgsim.replay_game(trace_path, game)
+        assert 'Replay of game {} matches its trace'.format(game) in capsys.readouterr().out
+
+
+def test_records_are_read_in_place(tmp_path):
+    if not mtgsim.numpy_available():
+        return
+    lines = deck('gisela.dck')
+    path = str(tmp_path / 'games.rec')
+    games = mtgsim.RECORD_BLOCK_SIZE + 100
+    stats = mtgsim.record_simulation(lines, games, 3, 1, records_path=path)
+    records = mtgsim.read_records(path)
+    assert records['mana'].shape == (games, 3)
+    assert [int(total) for total in records['mana'].sum(axis=0)] == stats.mana_sums
+    for name, column in records.items():
+        # Views of the file's map, not copies in memory
+        assert isinstance(column.base, mmap.mmap), name
+        mapped = mtgsim.np.frombuffer(column.base, dtype=mtgsim.np.uint8)
+        assert mtgsim.np.shares_memory(column, mapped), name
+
+
+def test_checkpoint_resume_matches_an_uninterrupted_run(tmp_path, capsys):
+    lines = deck('gisela.dck')
+    library, commander = mtgsim.cached_deck(lines)
+    path = str(tmp_path / 'run.json')
+    mtgsim.checkpointed_simulation(path, lines, library, commander, 1500, 6, 11)
+    resumed = mtgsim.checkpointed_simulation(path, lines, library, commander, 2500, 6, 11, resume=True)
+    assert 'Resuming after 1500 games' in capsys.readouterr().out
+    assert report(resumed) == report(mtgsim.run_simulation(lines, library, commander, 2500, 6, 11))
+
+
+def test_priority_tables_share_cached_keys_and_are_freed():
+    lines = deck('sealed.dck')
+    library, commander = mtgsim.cached_deck(lines)
+    mtgsim.simulate(lines, 20, 5, seed=1, strategy=mtgsim.Strategy(play_priorities=list(mtgsim.PLAY_PRIORITIES)))
+    sizes = [len(card.priority_keys) for card in library]
+    tables = []
+    for i in range(5):
+        strategy = mtgsim.Strategy(play_priorities=list(mtgsim.PLAY_PRIORITIES))
+        tables.append(weakref.ref(strategy.play_table))
+        mtgsim.simulate(lines, 20, 5, seed=1, strategy=strategy)
+        del strategy
+    gc.collect()
+    assert [len(card.priority_keys) for card in library] == sizes
+    assert all(table() is None for table in tables)
+
+
+class KeepEveryHand(mtgsim.Strategy):
+    def should_mulligan(self, hand):
+        return False
+
+
+def test_concurrent_simulations_match_serial_ones():
+    strategies = [mtgsim.DEFAULT_STRATEGY,
+                  mtgsim.Strategy(play_priorities=list(reversed(mtgsim.PLAY_PRIORITIES))),
+                  mtgsim.Strategy(play_priorities=[{'key': 'random'}],
+                                  discard_priorities=[{'key': '-managen+turn_effects+play_effects+mana_effects'}]),
+                  KeepEveryHand()]
+    jobs = [(deck(name), strategy, seed) for seed, (name, strategy) in
+            enumerate(itertools.product(('gisela.dck', 'sealed.dck', 'testing.dck'), strategies))]
+
+    def play(job):
+        lines, strategy, seed = job
+        return report(mtgsim.simulate(lines, 150, 8, seed=seed, strategy=strategy))
+    serial = [play(job) for job in jobs]
+    interval = sys.getswitchinterval()
+    # Switch threads often, so the games interleave.
+    sys.setswitchinterval(1e-5)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+            concurrent_reports = list(executor.map(play, jobs + jobs))
+    finally:
+        sys.setswitchinterval(interval)
+    assert concurrent_reports == serial + serial
+    assert len(set(serial)) == len(serial)
+
+
+def test_profiler_counts_and_restores_everything():
+    originals = ([getattr(mtgsim, name) for name in mtgsim.PROFILED_PHASES + mtgsim.PROFILED_FUNCTIONS] +
+                 [owner.__dict__[name] for owner, name in mtgsim.PROFILED_METHODS] +
+                 [mtgsim.new_effect_spell, mtgsim.add_extra_play_effect])
+    effects = {name: (card.play_effects, card.turn_effects, card.mana_effects)
+               for name, card in mtgsim.cards.items()}
+    lines = deck('testing.dck')
+    expected = report(mtgsim.simulate(lines, 100, 8, seed=1))
+    profiler = mtgsim.Profiler()
+    profiler.enable()
+    try:
+        assert report(mtgsim.simulate(lines, 100, 8, seed=1)) == expected
+    finally:
+        profiler.disable()
+    phases = {name: profiler.calls[name] for name in profiler.calls if profiler.sections[name] == 'phase'}
+    assert phases.pop('mulligan_phase') == 100
+    # Every turn goes through each phase once.
+    assert len(set(phases.values())) == 1 and 100 < phases['main_phase'] <= 800
+    phase_time = sum(profiler.times[name] for name in profiler.calls if profiler.sections[name] == 'phase')
+    assert 0.5 * profiler.elapsed < phase_time <= profiler.elapsed
+    assert profiler.times['main_phase'] >= profiler.times['should_play']
+    # Effects of the spells and play effects made as games run count too.
+    assert profiler.calls['Draw Spell play: draw_cards_effect.fun'] > 0
+    assert profiler.calls['Extra play: draw_cards_effect.fun'] > 0
+    assert profiler.calls["Mind's Eye turn: add_effect_spell.fun"] > 0
+    out = io.StringIO()
+    profiler.report(out)
+    assert 'Draw Spell play: draw_cards_effect.fun' in out.getvalue()
+    assert originals == ([getattr(mtgsim, name) for name in mtgsim.PROFILED_PHASES + mtgsim.PROFILED_FUNCTIONS] +
+                         [owner.__dict__[name] for owner, name in mtgsim.PROFILED_METHODS] +
+                         [mtgsim.new_effect_spell, mtgsim.add_extra_play_effect])
+    assert all(effects[name][0] is card.play_effects and effects[name][1] is card.turn_effects and
+               effects[name][2] is card.mana_effects for name, card in mtgsim.cards.items())
+    assert report(mtgsim.simulate(lines, 100, 8, seed=1)) == expected
+
+
+def test_cache_key_is_stable_while_games_run(tmp_path, capsys):
+    # testing.dck has Mind's Eye, whose Draw Spells fill a priority key cache
+    # in the closure of add_effect_spell as games are played.
+    lines = deck('testing.dck')
+    library, commander = mtgsim.cached_deck(lines)
+    assert any(card.name == "Mind's Eye" for card in library)
+    before = mtgsim.cache_key(library, commander, 10, 1, False)
+    mtgsim.simulate(lines, 50, 10, seed=1)
+    assert mtgsim.cache_key(library, commander, 10, 1, False) == before
+    path = str(tmp_path / 'run.json')
+    mtgsim.checkpointed_simulation(path, lines, library, commander, 200, 10, 1)
+    resumed = mtgsim.checkpointed_simulation(path, lines, library, commander, 300, 10, 1, resume=True)
+    assert resumed is not None and resumed.num_games == 300
+    profiler = mtgsim.Profiler()
+    profiler.enable()
+    try:
+        library, commander = mtgsim.cached_deck(lines)
+        mtgsim.simulate(lines, 20, 10, seed=1)
+        assert mtgsim.cache_key(library, commander, 10, 1, False) == before
+    finally:
+        profiler.disable()